@@ -14,10 +14,23 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import asyncio
+import concurrent.futures
+import copy
+import hashlib
 import msgpack
+import queue
+import sqlite3
+import struct
 import sys
 import threading
 import time
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 sys.path.append("../../")
 
@@ -27,7 +40,6 @@ from bbc1.core.bbc_error import *
 from bbc1.core.message_key_types import KeyType
 from bbc1.core.bbc_config import DEFAULT_CORE_PORT
 from bbc1.lib import app_support_lib
-from bbclib.libs import bbclib_binary
 
 
 NAME_OF_DB = 'ticket_db'
@@ -35,11 +47,19 @@ NAME_OF_DB = 'ticket_db'
 ticket_tx_id_table_definition = [
     ["tx_id", "BLOB"],
     ["tx", "BLOB"],
+    ["is_committed", "INTEGER"],
 ]
 
 ticket_id_table_definition = [
     ["ticket_id", "BLOB"],
     ["ticket", "BLOB"],
+    ["spec_id", "BLOB"],
+    ["time_of_origin", "INTEGER"],
+]
+
+ticket_spec_table_definition = [
+    ["spec_id", "BLOB"],
+    ["spec", "BLOB"],
 ]
 
 ticket_table_definition = [
@@ -50,7 +70,36 @@ ticket_table_definition = [
     ["ticket_id", "BLOB"],
     ["is_single", "INTEGER"],
     ["state", "INTEGER"],
-    ["last_modified", "INTEGER"]
+    ["last_modified", "INTEGER"],
+    ["uses", "INTEGER"],
+]
+
+ticket_attribute_table_definition = [
+    ["ticket_id", "BLOB"],
+    ["unit", "TEXT"],
+    ["value", "INTEGER"],
+    ["book_of", "INTEGER"],
+    ["time_of_begin", "INTEGER"],
+    ["time_of_end", "INTEGER"],
+]
+
+ticket_balance_table_definition = [
+    ["service_id", "BLOB"],
+    ["user_id", "BLOB"],
+    ["unit", "TEXT"],
+    ["time_of_end", "INTEGER"],
+    ["value", "INTEGER"],
+]
+
+ticket_supply_table_definition = [
+    ["service_id", "BLOB"],
+    ["unit", "TEXT"],
+    ["bucket", "INTEGER"],
+    ["value", "INTEGER"],
+]
+
+ticket_schema_table_definition = [
+    ["version", "INTEGER"],
 ]
 
 IDX_BOOTH_ID      = 0
@@ -61,10 +110,140 @@ IDX_TICKET_ID     = 4
 IDX_IS_SINGLE     = 5
 IDX_STATE         = 6
 IDX_LAST_MODIFIED = 7
+IDX_USES          = 8
 
 ST_FREE     = 0
 ST_RESERVED = 1
 ST_TAKEN    = 2
+ST_EXPIRED  = 3
+
+SUPPLY_BUCKET_SECONDS = 60 * 60
+
+# SCHEMA_MIGRATIONS[i] upgrades a database from version i to i + 1;
+# a step is either a statement or a callable taking the store.
+SCHEMA_MIGRATIONS = [
+    [
+        ('create index if not exists ticket_table_lease '
+         'on ticket_table (state, last_modified)'),
+        ('create index if not exists ticket_attribute_table_interval '
+         'on ticket_attribute_table (time_of_end, time_of_begin)'),
+        ('create unique index if not exists ticket_balance_table_key '
+         'on ticket_balance_table (service_id, user_id, unit, time_of_end)'),
+        ('create index if not exists ticket_balance_table_end '
+         'on ticket_balance_table (service_id, time_of_end)'),
+        ('create unique index if not exists ticket_supply_table_key '
+         'on ticket_supply_table (service_id, unit, bucket)'),
+    ],
+    [
+        ('create index if not exists ticket_table_utxo '
+         'on ticket_table (tx_id, event_idx)'),
+        ('create index if not exists ticket_table_holder '
+         'on ticket_table (service_id, user_id, state, ticket_id, uses)'),
+        ('create index if not exists ticket_table_ticket '
+         'on ticket_table (ticket_id, service_id, state, user_id, uses)'),
+        ('create index if not exists ticket_table_free '
+         'on ticket_table (service_id, user_id, ticket_id) '
+         'where state={0}').format(ST_FREE),
+        ('create index if not exists ticket_table_free_page '
+         'on ticket_table (service_id, user_id) where state={0}').format(
+         ST_FREE),
+    ],
+    [
+        ('delete from ticket_table where rowid not in '
+         '(select min(rowid) from ticket_table group by tx_id, event_idx)'),
+        'drop index if exists ticket_table_utxo',
+        ('create unique index if not exists ticket_table_utxo_key '
+         'on ticket_table (tx_id, event_idx)'),
+    ],
+    [
+        # rebuilds the tables derived from tickets and utxos, which
+        # databases written before them lack.
+        lambda store: store.backfill_attributes(),
+        'delete from ticket_balance_table',
+        ('insert into ticket_balance_table '
+         'select t.service_id, t.user_id, a.unit, a.time_of_end, '
+         'sum(a.value * coalesce(t.uses, a.book_of)) from ticket_table t '
+         'join ticket_attribute_table a on t.ticket_id=a.ticket_id '
+         'where t.state in ({0}, {1}) '
+         'group by t.service_id, t.user_id, a.unit, a.time_of_end').format(
+         ST_FREE, ST_RESERVED),
+        'delete from ticket_supply_table',
+        ('insert into ticket_supply_table '
+         'select t.service_id, a.unit, a.time_of_end / {2}, '
+         'sum(a.value * coalesce(t.uses, a.book_of)) from ticket_table t '
+         'join ticket_attribute_table a on t.ticket_id=a.ticket_id '
+         'where t.state in ({0}, {1}) and t.user_id!=t.service_id '
+         'group by t.service_id, a.unit, a.time_of_end / {2}').format(
+         ST_FREE, ST_RESERVED, SUPPLY_BUCKET_SECONDS),
+    ],
+    [
+        # every ticket_table query filtering on these columns is served
+        # by holder, ticket or utxo_key, so these only slow down writes.
+        'drop index if exists ticket_table_idx_0',
+        'drop index if exists ticket_table_idx_1',
+        'drop index if exists ticket_table_idx_2',
+        'drop index if exists ticket_table_idx_4',
+        'drop index if exists ticket_table_free',
+    ],
+]
+
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+# version, description type and description size
+SPEC_HEAD = struct.Struct('<HBH')
+# value, book_of, time_to_begin, time_to_end, expire_after and options
+SPEC_TAIL = struct.Struct('<QHQQQH')
+TICKET_HEAD = struct.Struct('<B')
+TICKET_ID_SIZE = struct.Struct('<H')
+TICKET_ORIGIN = struct.Struct('<Q')
+TICKET_USES = struct.Struct('<H')
+
+MAX_EVENTS_PER_TX = 100
+
+# keeps "in (...)" queries below the default SQLite variable limit.
+BALANCE_QUERY_CHUNK = 500
+UTXO_INSERT_CHUNK = 100
+UTXO_ROW = '(?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+# "returning" (SQLite 3.35) tells which rows an "insert or ignore" wrote.
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+DEFAULT_PAGE_SIZE = 500
+
+DEFAULT_SWEEP_BATCH_SIZE = 500
+DEFAULT_RESERVATION_LEASE = 60 * 10
+
+DEFAULT_INSERT_WINDOW = 32
+DEFAULT_REQUEST_TIMEOUT = 30
+
+DEFAULT_SIGNING_WORKERS = 4
+DEFAULT_SIGNING_BATCH = 64
+
+DEFAULT_SIGNER_CACHE_SIZE = 1024
+# the ID map is not consulted for cached signer keys, so a revoked or
+# remapped key may still be accepted for up to this many seconds unless
+# invalidate_signer_cache() is called after the map changes.
+DEFAULT_SIGNER_CACHE_TTL = 30
+DEFAULT_VERIFY_BATCH = 16
+
+DEFAULT_BUSY_TIMEOUT = 30
+
+DEFAULT_TX_CACHE_SIZE = 1024
+DEFAULT_TICKET_CACHE_SIZE = 4096
+DEFAULT_SPEC_CACHE_SIZE = 1024
+
+
+def verify_signatures(items):
+    for key_type, pubkey, signature, digest in items:
+        sig = bbclib.BBcSignature(key_type=key_type)
+        sig.add(signature=signature, pubkey=pubkey)
+        if not sig.verify(digest):
+            return False
+    return True
+
+
+def verify_signatures_batch(batches):
+    return [verify_signatures(items) for items in batches]
 
 
 class Constants(app_support_lib.Constants):
@@ -218,26 +397,25 @@ class TicketSpec:
 
     @staticmethod
     def from_serialized_data(ptr, data):
+        view = memoryview(data)
         try:
-            ptr, version = bbclib_binary.get_n_byte_int(ptr, 2, data)
-            ptr, t = bbclib_binary.get_n_byte_int(ptr, 1, data)
-            ptr, size = bbclib_binary.get_n_byte_int(ptr, 2, data)
-            ptr, v = bbclib_binary.get_n_bytes(ptr, size, data)
+            version, t, size = SPEC_HEAD.unpack_from(view, ptr)
+            ptr += SPEC_HEAD.size
+            v = view[ptr:ptr + size]
+            ptr += size
             if t == Constants.DESC_STRING:
-                description = v.decode()
+                description = str(v, 'utf-8')
             elif t == Constants.DESC_DICTIONARY:
                 description = msgpack.loads(v, raw=False)
             else:
-                description = v
-            ptr, size = bbclib_binary.get_n_byte_int(ptr, 1, data)
-            ptr, v = bbclib_binary.get_n_bytes(ptr, size, data)
-            unit = v.decode()
-            ptr, value = bbclib_binary.get_n_byte_int(ptr, 8, data)
-            ptr, book_of = bbclib_binary.get_n_byte_int(ptr, 2, data)
-            ptr, time_to_begin = bbclib_binary.get_n_byte_int(ptr, 8, data)
-            ptr, time_to_end = bbclib_binary.get_n_byte_int(ptr, 8, data)
-            ptr, expire_after = bbclib_binary.get_n_byte_int(ptr, 8, data)
-            ptr, v = bbclib_binary.get_n_byte_int(ptr, 2, data)
+                description = bytes(v)
+            size = view[ptr]
+            ptr += 1
+            unit = str(view[ptr:ptr + size], 'utf-8')
+            ptr += size
+            value, book_of, time_to_begin, time_to_end, expire_after, v = \
+                    SPEC_TAIL.unpack_from(view, ptr)
+            ptr += SPEC_TAIL.size
             option_divisible = v & Constants.O_BIT_DIVISIBLE != 0
             option_transferable = v & Constants.O_BIT_TRANSFERABLE != 0
             option_relative_time = v & Constants.O_BIT_RELATIVE_TIME != 0
@@ -254,29 +432,16 @@ class TicketSpec:
 
 
     def serialize(self):
-        dat = bytearray(bbclib_binary.to_2byte(self.version))
         if isinstance(self.description, str):
-            dat.extend(bbclib_binary.to_1byte(Constants.DESC_STRING))
-            string = self.description.encode()
-            dat.extend(bbclib_binary.to_2byte(len(string)))
-            dat.extend(string)
+            t = Constants.DESC_STRING
+            raw = self.description.encode()
         elif isinstance(self.description, dict):
-            dat.extend(bbclib_binary.to_1byte(Constants.DESC_DICTIONARY))
+            t = Constants.DESC_DICTIONARY
             raw = msgpack.dumps(self.description, use_bin_type=True)
-            dat.extend(bbclib_binary.to_2byte(len(raw)))
-            dat.extend(raw)
         else:
-            dat.extend(bbclib_binary.to_1byte(Constants.DESC_BINARY))
-            dat.extend(bbclib_binary.to_2byte(len(self.description)))
-            dat.extend(self.description)
-        string = self.unit.encode()
-        dat.extend(bbclib_binary.to_1byte(len(string)))
-        dat.extend(string)
-        dat.extend(bbclib_binary.to_8byte(self.value))
-        dat.extend(bbclib_binary.to_2byte(self.book_of))
-        dat.extend(bbclib_binary.to_8byte(self.time_to_begin))
-        dat.extend(bbclib_binary.to_8byte(self.time_to_end))
-        dat.extend(bbclib_binary.to_8byte(self.expire_after))
+            t = Constants.DESC_BINARY
+            raw = self.description
+        unit = self.unit.encode()
 
         options = Constants.O_BIT_NONE
         if self.option_divisible:
@@ -285,41 +450,77 @@ class TicketSpec:
             options |= Constants.O_BIT_TRANSFERABLE
         if self.option_relative_time:
             options |= Constants.O_BIT_RELATIVE_TIME
-        dat.extend(bbclib_binary.to_2byte(options))
-        return bytes(dat)
+
+        return b''.join((
+            SPEC_HEAD.pack(self.version, t, len(raw)),
+            raw,
+            bytes((len(unit),)),
+            unit,
+            SPEC_TAIL.pack(self.value, self.book_of, self.time_to_begin,
+                    self.time_to_end, self.expire_after, options),
+        ))
 
 
 class Ticket:
 
-    T_TICKET    = 0b0000
-    T_TICKET_ID = 0b0001
+    T_TICKET      = 0b0000
+    T_TICKET_ID   = 0b0001
+    T_TICKET_USES = 0b0010
 
-    def __init__(self, ticket_id=None, spec=None, time_of_origin=None):
+    def __init__(self, ticket_id=None, spec=None, time_of_origin=None,
+            uses=None):
         self.ticket_id = ticket_id
         self.spec = spec
         self.time_of_origin = time_of_origin
+        self.uses = uses
 
 
     @staticmethod
     def from_serialized_data(ptr, data):
+        view = memoryview(data)
         try:
-            ptr, type = bbclib_binary.get_n_byte_int(ptr, 1, data)
+            type = view[ptr]
+            ptr += TICKET_HEAD.size
             if type == Ticket.T_TICKET:
                 ticket_id = None
-                ptr, spec = TicketSpec.from_serialized_data(ptr, data)
-                ptr, time_of_origin = bbclib_binary.get_n_byte_int(ptr,
-                        8, data)
-            elif type == Ticket.T_TICKET_ID:
-                ptr, ticket_id = bbclib_binary.get_bigint(ptr, data)
+                ptr, spec = TicketSpec.from_serialized_data(ptr, view)
+                time_of_origin, = TICKET_ORIGIN.unpack_from(view, ptr)
+                ptr += TICKET_ORIGIN.size
+                uses = None
+            elif type in (Ticket.T_TICKET_ID, Ticket.T_TICKET_USES):
+                size, = TICKET_ID_SIZE.unpack_from(view, ptr)
+                ptr += TICKET_ID_SIZE.size
+                ticket_id = bytes(view[ptr:ptr + size])
+                ptr += size
                 spec = None
                 time_of_origin = None
+                uses = None
+                if type == Ticket.T_TICKET_USES:
+                    uses, = TICKET_USES.unpack_from(view, ptr)
+                    ptr += TICKET_USES.size
+            else:
+                raise TypeError('unknown ticket type')
         except:
             raise
 
-        obj = Ticket(ticket_id, spec, time_of_origin)
+        obj = Ticket(ticket_id, spec, time_of_origin, uses)
         return ptr, obj
 
 
+    def get_time_interval(self):
+        time_of_begin = self.spec.time_to_begin
+        time_of_end = self.spec.time_to_end
+        if self.spec.option_relative_time:
+            time_of_begin = min(time_of_begin + self.time_of_origin,
+                    Constants.MAX_INT64)
+            time_of_end = min(time_of_end + self.time_of_origin,
+                    Constants.MAX_INT64)
+        if self.spec.expire_after > 0:
+            time_of_end = min(time_of_end,
+                    self.time_of_origin + self.spec.expire_after)
+        return time_of_begin, time_of_end
+
+
     def is_divisible(self):
         return self.spec.option_divisible
 
@@ -332,58 +533,429 @@ class Ticket:
         return self.spec.option_transferable
 
 
-    def redeem(self):
-        pass
+    def redeem(self, uses=1):
+        if self.ticket_id is None:
+            raise ValueError('ticket is not issued yet')
+        remaining = self.spec.book_of if self.uses is None else self.uses
+        if uses <= 0 or uses > remaining:
+            raise ValueError('invalid number of uses')
+        return Ticket(ticket_id=self.ticket_id, uses=remaining - uses)
 
 
     def serialize(self):
         if self.ticket_id is None:
-            dat = bytearray(bbclib_binary.to_1byte(Ticket.T_TICKET))
-            dat.extend(self.spec.serialize())
-            dat.extend(bbclib_binary.to_8byte(self.time_of_origin))
+            return b''.join((
+                TICKET_HEAD.pack(Ticket.T_TICKET),
+                self.spec.serialize(),
+                TICKET_ORIGIN.pack(self.time_of_origin),
+            ))
+        # fixed 32-byte id, as written by bbclib to_bigint().
+        if self.uses is None:
+            return b''.join((
+                TICKET_HEAD.pack(Ticket.T_TICKET_ID),
+                TICKET_ID_SIZE.pack(32),
+                self.ticket_id,
+            ))
+        return b''.join((
+            TICKET_HEAD.pack(Ticket.T_TICKET_USES),
+            TICKET_ID_SIZE.pack(32),
+            self.ticket_id,
+            TICKET_USES.pack(self.uses),
+        ))
+
+
+    def split(self, values):
+        if self.spec is None:
+            raise ValueError('ticket spec is unknown')
+        if not self.spec.option_divisible:
+            raise TypeError('ticket is not divisible')
+        if len(values) < 2 or any(value <= 0 for value in values):
+            raise ValueError('invalid division')
+        if sum(values) != self.spec.value:
+            raise ValueError('value is not conserved')
+
+        successors = []
+        for value in values:
+            spec = copy.copy(self.spec)
+            spec.value = value
+            successors.append(Ticket(spec=spec,
+                    time_of_origin=self.time_of_origin))
+        return successors
+
+
+class TicketView:
+
+    def __init__(self, data, ptr=0):
+        self.view = memoryview(data)
+        self.ptr = ptr
+        self.type = self.view[ptr]
+        ptr += TICKET_HEAD.size
+        self._spec = None
+        self._tail = None
+        self.uses = None
+        if self.type == Ticket.T_TICKET:
+            self.ticket_id = None
+            _, t, size = SPEC_HEAD.unpack_from(self.view, ptr)
+            self.desc_type = t
+            self.desc_ptr = ptr + SPEC_HEAD.size
+            self.unit_ptr = self.desc_ptr + size
+            self.tail_ptr = self.unit_ptr + 1 + self.view[self.unit_ptr]
+            self.end = self.tail_ptr + SPEC_TAIL.size + TICKET_ORIGIN.size
+        elif self.type in (Ticket.T_TICKET_ID, Ticket.T_TICKET_USES):
+            size, = TICKET_ID_SIZE.unpack_from(self.view, ptr)
+            ptr += TICKET_ID_SIZE.size
+            self.ticket_id = bytes(self.view[ptr:ptr + size])
+            self.end = ptr + size
+            if self.type == Ticket.T_TICKET_USES:
+                self.uses, = TICKET_USES.unpack_from(self.view, self.end)
+                self.end += TICKET_USES.size
         else:
-            dat = bytearray(bbclib_binary.to_1byte(Ticket.T_TICKET_ID))
-            dat.extend(bbclib_binary.to_bigint(self.ticket_id))
-        return bytes(dat)
+            raise TypeError('unknown ticket type')
+
+
+    @property
+    def book_of(self):
+        return self.get_tail()[1]
+
+
+    @property
+    def description(self):
+        v = self.view[self.desc_ptr:self.unit_ptr]
+        if self.desc_type == Constants.DESC_STRING:
+            return str(v, 'utf-8')
+        elif self.desc_type == Constants.DESC_DICTIONARY:
+            return msgpack.loads(v, raw=False)
+        return bytes(v)
+
+
+    @property
+    def expire_after(self):
+        return self.get_tail()[4]
+
+
+    @staticmethod
+    def from_serialized_data(ptr, data):
+        obj = TicketView(data, ptr)
+        return obj.end, obj
+
+
+    def get_tail(self):
+        if self._tail is None:
+            self._tail = SPEC_TAIL.unpack_from(self.view, self.tail_ptr)
+        return self._tail
+
+
+    def get_time_interval(self):
+        time_of_begin = self.time_to_begin
+        time_of_end = self.time_to_end
+        if self.is_relative_time():
+            time_of_begin = min(time_of_begin + self.time_of_origin,
+                    Constants.MAX_INT64)
+            time_of_end = min(time_of_end + self.time_of_origin,
+                    Constants.MAX_INT64)
+        if self.expire_after > 0:
+            time_of_end = min(time_of_end,
+                    self.time_of_origin + self.expire_after)
+        return time_of_begin, time_of_end
+
+
+    def is_divisible(self):
+        return self.get_tail()[5] & Constants.O_BIT_DIVISIBLE != 0
+
+
+    def is_relative_time(self):
+        return self.get_tail()[5] & Constants.O_BIT_RELATIVE_TIME != 0
+
+
+    def is_transferable(self):
+        return self.get_tail()[5] & Constants.O_BIT_TRANSFERABLE != 0
+
+
+    def serialize(self):
+        if self.ticket_id is None or self.type != Ticket.T_TICKET:
+            return bytes(self.view[self.ptr:self.end])
+        return Ticket(ticket_id=self.ticket_id).serialize()
 
 
-    def split(self):
-        pass
+    @property
+    def spec(self):
+        if self.type != Ticket.T_TICKET:
+            return None
+        if self._spec is None:
+            _, self._spec = TicketSpec.from_serialized_data(
+                    self.ptr + TICKET_HEAD.size, self.view)
+        return self._spec
+
+
+    @property
+    def time_of_origin(self):
+        if self.type != Ticket.T_TICKET:
+            return None
+        return TICKET_ORIGIN.unpack_from(self.view,
+                self.tail_ptr + SPEC_TAIL.size)[0]
+
+
+    @property
+    def time_to_begin(self):
+        return self.get_tail()[2]
+
+
+    @property
+    def time_to_end(self):
+        return self.get_tail()[3]
+
+
+    @property
+    def unit(self):
+        return str(self.view[self.unit_ptr + 1:self.tail_ptr], 'utf-8')
+
+
+    @property
+    def value(self):
+        return self.get_tail()[0]
+
+
+class LRUCache:
+
+    def __init__(self, capacity):
+        if capacity < 0:
+            raise ValueError('capacity must not be negative')
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def pop(self, key):
+        with self.lock:
+            return self.entries.pop(key, None)
+
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class ConnectionPool:
+
+    def __init__(self, path, timeout=DEFAULT_BUSY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.get().execute('pragma journal_mode=wal').fetchall()
+
+
+    def close(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+            self.local = threading.local()
+        for connection in connections:
+            connection.close()
+
+
+    def get(self):
+        # one connection per thread; in WAL mode readers never wait for
+        # the writer.
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                    isolation_level=None, check_same_thread=False)
+            with self.lock:
+                self.connections.append(connection)
+                self.local.connection = connection
+        return connection
 
 
 class Store:
 
-    lock = threading.Lock()
+    locks = dict()
+    locks_lock = threading.Lock()
 
 
-    def __init__(self, domain_id, service_id, app):
+    def __init__(self, domain_id, service_id, app,
+            tx_cache_size=DEFAULT_TX_CACHE_SIZE,
+            ticket_cache_size=DEFAULT_TICKET_CACHE_SIZE,
+            insert_window=DEFAULT_INSERT_WINDOW,
+            signer_cache_size=DEFAULT_SIGNER_CACHE_SIZE,
+            signer_cache_ttl=DEFAULT_SIGNER_CACHE_TTL, verify_workers=None,
+            spec_cache_size=DEFAULT_SPEC_CACHE_SIZE):
         self.domain_id = domain_id
         self.service_id = service_id
         self.app = app
+        self.tx_cache = LRUCache(tx_cache_size)
+        self.ticket_cache = LRUCache(ticket_cache_size)
+        self.spec_cache = LRUCache(spec_cache_size)
+        self.insert_window = threading.BoundedSemaphore(insert_window)
+        self.signer_cache = LRUCache(signer_cache_size)
+        self.signer_cache_ttl = signer_cache_ttl
+        self.verify_pool = None
+        if verify_workers is not None:
+            self.verify_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=verify_workers)
         self.db = app_support_lib.Database()
         self.db.setup_db(domain_id, NAME_OF_DB)
+        rows = self.db.exec_sql(domain_id, NAME_OF_DB, 'pragma database_list')
+        path = next((row[2] for row in rows if row[1] == 'main'), '')
+        self.pool = ConnectionPool(path) if path else None
+        self.lock = Store.get_lock(path or domain_id)
         self.db.create_table_in_db(domain_id, NAME_OF_DB,
                 'ticket_table',
                 ticket_table_definition,
-                indices=[0, 1, 2, 4])
+                indices=[])
+        self.add_missing_columns('ticket_table', ticket_table_definition)
         self.db.create_table_in_db(domain_id, NAME_OF_DB,
                 'ticket_tx_id_table',
                 ticket_tx_id_table_definition,
                 primary_key=0, indices=[1])
+        self.add_missing_columns('ticket_tx_id_table',
+                ticket_tx_id_table_definition)
         self.db.create_table_in_db(domain_id, NAME_OF_DB,
                 'ticket_id_table',
                 ticket_id_table_definition,
                 primary_key=0, indices=[1])
+        self.add_missing_columns('ticket_id_table',
+                ticket_id_table_definition)
+        self.db.create_table_in_db(domain_id, NAME_OF_DB,
+                'ticket_spec_table',
+                ticket_spec_table_definition,
+                primary_key=0, indices=[])
+        self.db.create_table_in_db(domain_id, NAME_OF_DB,
+                'ticket_attribute_table',
+                ticket_attribute_table_definition,
+                primary_key=0, indices=[])
+        self.db.create_table_in_db(domain_id, NAME_OF_DB,
+                'ticket_balance_table',
+                ticket_balance_table_definition,
+                indices=[])
+        self.db.create_table_in_db(domain_id, NAME_OF_DB,
+                'ticket_supply_table',
+                ticket_supply_table_definition,
+                indices=[])
+        self.db.create_table_in_db(domain_id, NAME_OF_DB,
+                'ticket_schema_table',
+                ticket_schema_table_definition,
+                indices=[])
+        self.migrate()
+
+
+    def add_missing_columns(self, table, definition):
+        rows = self.exec_sql('pragma table_info({0})'.format(table))
+        columns = set(row[1] for row in rows)
+        for name, t in definition:
+            if name not in columns:
+                self.exec_sql('alter table {0} add column {1} {2}'.format(
+                        table, name, t))
+
+
+    def backfill_attributes(self):
+        rows = self.exec_sql(
+            ('select i.ticket_id, i.ticket from ticket_id_table i '
+             'left join ticket_attribute_table a '
+             'on i.ticket_id=a.ticket_id where '
+             'a.ticket_id is null and i.ticket is not null')
+        )
+        for ticket_id, ticket in rows:
+            self.put_ticket(ticket_id, ticket)
+
+
+    def begin(self):
+        self.lock.acquire()
+        try:
+            # take the write lock up front, so that a concurrent writer on
+            # another connection cannot invalidate this transaction.
+            self.exec_sql('begin immediate')
+        except:
+            self.lock.release()
+            raise
+
+
+    def cache_signers(self, tx):
+        now = time.time()
+        for user_id, idx in tx.userid_sigidx_mapping.items():
+            if idx >= len(tx.signatures) or tx.signatures[idx].pubkey is None:
+                continue
+            entry = self.signer_cache.get(user_id)
+            if entry is None or now - entry[0] > self.signer_cache_ttl:
+                entry = (now, frozenset())
+            self.signer_cache.put(user_id,
+                    (entry[0], entry[1] | {tx.signatures[idx].pubkey}))
 
 
     def close(self):
+        if self.verify_pool is not None:
+            self.verify_pool.shutdown()
+        if self.pool is not None:
+            self.pool.close()
         self.db.close_db(self.domain_id, NAME_OF_DB)
 
 
+    def commit(self):
+        try:
+            self.exec_sql('commit')
+        finally:
+            self.lock.release()
+
+
     def delete_utxo(self, tx_id, idx):
-        return self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
+        rows = self.exec_sql(
+            ('select user_id, ticket_id, state, uses from ticket_table '
+             'where tx_id=? and event_idx=? and state!=?'),
+            tx_id,
+            idx,
+            ST_TAKEN
+        )
+        if len(rows) <= 0:
+            return None
+        self.exec_sql(
             ('update ticket_table set state=?, last_modified=? where '
              'tx_id=? and event_idx=?'),
             ST_TAKEN,
@@ -391,50 +963,249 @@ class Store:
             tx_id,
             idx
         )
+        return rows[0]
+
+
+    def exec_sql(self, sql, *args):
+        if self.pool is None:
+            return self.db.exec_sql(self.domain_id, NAME_OF_DB, sql, *args)
+        return self.pool.get().execute(sql, args).fetchall()
+
+
+    def exec_write(self, sql, *args):
+        # returns the number of rows changed.
+        if self.pool is None:
+            self.db.exec_sql(self.domain_id, NAME_OF_DB, sql, *args)
+            rows = self.db.exec_sql(self.domain_id, NAME_OF_DB,
+                    'select changes()')
+            return rows[0][0]
+        return self.pool.get().execute(sql, args).rowcount
 
 
     def get_balance_of(self, user_id, eval_time=None):
-        pass
+        if eval_time is None:
+            eval_time = -1
+        # "+" keeps the planner on the per-user key index.
+        rows = self.exec_sql(
+            ('select unit, sum(value) from ticket_balance_table where '
+             'service_id=? and user_id=? and +time_of_end>? group by unit'),
+            self.service_id,
+            user_id,
+            eval_time
+        )
+        return {unit: value for unit, value in rows if value != 0}
+
+
+    def get_balances_of(self, user_ids, eval_time=None):
+        if eval_time is None:
+            eval_time = -1
+        user_ids = list(dict.fromkeys(user_ids))
+
+        keys = {}
+        slots = []
+        values = []
+        books = []
+        ends = []
+        for i in range(0, len(user_ids), BALANCE_QUERY_CHUNK):
+            chunk = user_ids[i:i + BALANCE_QUERY_CHUNK]
+            rows = self.exec_sql(
+                ('select t.user_id, a.unit, a.value, '
+                 'coalesce(t.uses, a.book_of), a.time_of_end from '
+                 'ticket_table t '
+                 'join ticket_attribute_table a on t.ticket_id=a.ticket_id '
+                 'where t.service_id=? and t.state in (?, ?) and '
+                 't.user_id in ({0})').format(', '.join('?' * len(chunk))),
+                self.service_id,
+                ST_FREE,
+                ST_RESERVED,
+                *chunk
+            )
+            for user_id, unit, value, book_of, time_of_end in rows:
+                slots.append(keys.setdefault((user_id, unit), len(keys)))
+                values.append(value)
+                books.append(book_of)
+                ends.append(time_of_end)
+
+        if np is not None:
+            slots = np.array(slots, dtype=np.int64)
+            mask = np.array(ends, dtype=np.int64) > eval_time
+            amounts = np.array(values, dtype=np.int64) \
+                    * np.array(books, dtype=np.int64)
+            totals = np.zeros(len(keys), dtype=np.int64)
+            np.add.at(totals, slots[mask], amounts[mask])
+            totals = totals.tolist()
+        else:
+            totals = [0] * len(keys)
+            for slot, value, book_of, time_of_end in zip(slots, values,
+                    books, ends):
+                if time_of_end > eval_time:
+                    totals[slot] += value * book_of
+
+        balances = {user_id: {} for user_id in user_ids}
+        for (user_id, unit), slot in keys.items():
+            if totals[slot] != 0:
+                balances[user_id][unit] = totals[slot]
+        return balances
+
+
+    def get_local_tx(self, tx_id):
+        tx = self.tx_cache.get(tx_id)
+        if tx is not None:
+            return tx
+
+        tx = self.read_tx(tx_id)
+        if tx is not None:
+            self.tx_cache.put(tx_id, tx)
+        return tx
+
+
+    def get_cached_signatures(self, tx, user_id):
+        # None unless every signer's public key is already known to be mapped.
+        if user_id not in tx.userid_sigidx_mapping:
+            return None
+        now = time.time()
+        digest = tx.digest()
+        items = []
+        for user_id, idx in tx.userid_sigidx_mapping.items():
+            if idx >= len(tx.signatures):
+                return None
+            sig = tx.signatures[idx]
+            if sig.not_initialized or sig.pubkey is None:
+                return None
+            entry = self.signer_cache.get(user_id)
+            if entry is None or now - entry[0] > self.signer_cache_ttl \
+                    or sig.pubkey not in entry[1]:
+                return None
+            items.append((sig.key_type, sig.pubkey, sig.signature, digest))
+        return items
+
+
+    @staticmethod
+    def get_lock(key):
+        # stores sharing a database share a lock; others do not contend.
+        with Store.locks_lock:
+            return Store.locks.setdefault(key, threading.RLock())
+
+
+    def get_next_expiry(self, eval_time):
+        rows = self.exec_sql(
+            ('select min(time_of_end) from ticket_attribute_table where '
+             'time_of_end>?'),
+            eval_time
+        )
+        if len(rows) <= 0:
+            return None
+        return rows[0][0]
 
 
     def get_ticket(self, ticket_id):
-        rows = self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
-            'select ticket from ticket_id_table where ticket_id=?',
+        # ticket bodies are immutable once stored, so no invalidation.
+        ticket = self.ticket_cache.get(ticket_id)
+        if ticket is not None:
+            return ticket
+
+        rows = self.exec_sql(
+            ('select ticket, spec_id, time_of_origin from ticket_id_table '
+             'where ticket_id=?'),
             ticket_id
         )
         if len(rows) <= 0:
             return None
-        _, ticket = Ticket.from_serialized_data(0, rows[0][0])
+        if rows[0][0] is not None:
+            ticket = TicketView(rows[0][0])
+        else:
+            ticket = Ticket(spec=self.get_spec(rows[0][1]),
+                    time_of_origin=rows[0][2])
+        self.ticket_cache.put(ticket_id, ticket)
         return ticket
 
 
+    def get_spec(self, spec_id):
+        # identical specs are parsed once and shared by their tickets.
+        spec = self.spec_cache.get(spec_id)
+        if spec is not None:
+            return spec
+
+        rows = self.exec_sql(
+            'select spec from ticket_spec_table where spec_id=?',
+            spec_id
+        )
+        if len(rows) <= 0:
+            return None
+        _, spec = TicketSpec.from_serialized_data(0, rows[0][0])
+        self.spec_cache.put(spec_id, spec)
+        return spec
+
+
+    def get_total_supply(self, eval_time=None):
+        if eval_time is None:
+            rows = self.exec_sql(
+                ('select unit, sum(value) from ticket_supply_table where '
+                 'service_id=? group by unit'),
+                self.service_id
+            )
+            return {unit: value for unit, value in rows if value != 0}
+
+        # whole buckets after eval_time, then the bucket containing it.
+        bucket = eval_time // SUPPLY_BUCKET_SECONDS
+        supply = dict()
+        rows = self.exec_sql(
+            ('select unit, sum(value) from ticket_supply_table where '
+             'service_id=? and bucket>? group by unit'),
+            self.service_id,
+            bucket
+        )
+        for unit, value in rows:
+            supply[unit] = supply.get(unit, 0) + value
+        rows = self.exec_sql(
+            ('select unit, sum(value) from ticket_balance_table where '
+             'service_id=? and time_of_end>? and time_of_end<? and '
+             'user_id!=? group by unit'),
+            self.service_id,
+            eval_time,
+            (bucket + 1) * SUPPLY_BUCKET_SECONDS,
+            self.service_id
+        )
+        for unit, value in rows:
+            supply[unit] = supply.get(unit, 0) + value
+        return {unit: value for unit, value in supply.items() if value != 0}
+
+
     def get_tx(self, tx_id):
-        self.app.search_transaction(tx_id)
+        tx = self.get_local_tx(tx_id)
+        if tx is not None:
+            return tx
+
+        self.app.callback.send(self.app.search_transaction, tx_id)
         res = self.app.callback.synchronize()
         if res[KeyType.status] < ESUCCESS:
             raise ValueError('not found')
         tx, fmt = bbclib.deserialize(res[KeyType.transaction_data])
+
+        self.tx_cache.put(tx_id, tx)
         return tx
 
 
     def get_usable_event(self, user_id, ticket_id):
-        rows = self.read_utxo(user_id, ticket_id)
-        if len(rows) <= 0:
-            raise
-        tx_id = rows[0][IDX_TX_ID]
-        index = rows[0][IDX_EVENT_IDX]
-        return self.get_tx(tx_id), index
+        return self.get_usable_events(user_id, [ticket_id])[0]
+
+
+    def get_usable_events(self, user_id, ticket_ids):
+        txs = dict()
+        events = []
+        for tx_id, index in self.read_usable_utxos(user_id, ticket_ids):
+            if tx_id not in txs:
+                txs[tx_id] = self.get_tx(tx_id)
+            events.append((txs[tx_id], index))
+        return events
 
 
     def insert(self, tx, user_id, idPublickeyMap):
-        if idPublickeyMap.verify_signers(tx, self.service_id,
-                user_id) == False:
+        if not self.verify_signers(tx, user_id, idPublickeyMap):
             raise RuntimeError('signers not verified')
 
         self.push_tx(tx.transaction_id, tx)
-        ret = self.app.insert_transaction(tx)
+        ret = self.app.callback.send(self.app.insert_transaction, tx)
         assert ret
         res = self.app.callback.synchronize()
         if res[KeyType.status] < ESUCCESS:
@@ -442,79 +1213,191 @@ class Store:
 
 
     def inserted(self, tx_id):
-        tx = self.take_tx(tx_id)
-        if tx is None:
-            return
+        # all effects of a notified transaction, including taking it off
+        # the pending table, are committed at once.
+        self.begin()
+        try:
+            tx = self.take_tx(tx_id)
+            if tx is None:
+                self.rollback()
+                return
+
+            # FIXME: check validity
+            utxos = []
+            for i, event in enumerate(tx.events):
+                if event.asset_group_id == self.service_id:
+                    ticket = TicketView(event.asset.asset_body)
+                    if ticket.ticket_id is None:
+                        ticket.ticket_id = event.asset.asset_id
+                        self.put_ticket(ticket.ticket_id,
+                                event.asset.asset_body)
+                    utxos.append((event.asset.user_id, i, ticket.ticket_id,
+                            ticket.uses))
+
+            for user_id, _, ticket_id, uses in self.write_utxos(
+                    tx.transaction_id, utxos):
+                self.update_balance(user_id, ticket_id, 1, uses)
+
+            for ref in tx.references:
+                if ref.asset_group_id == self.service_id:
+                    row = self.delete_utxo(ref.transaction_id,
+                            ref.event_index_in_ref)
+                    if row is not None and row[2] != ST_EXPIRED:
+                        self.update_balance(row[0], row[1], -1, row[3])
+        except:
+            self.rollback()
+            raise
+        self.commit()
 
-        # FIXME: check validity
-        for i, event in enumerate(tx.events):
-            if event.asset_group_id == self.service_id:
-                _, ticket = Ticket.from_serialized_data(0,
-                        event.asset.asset_body)
-                if ticket.ticket_id is None:
-                    ticket.ticket_id = event.asset.asset_id
-                    self.put_ticket(ticket.ticket_id, event.asset.asset_body)
-                self.write_utxo(event.asset.user_id,
-                        tx.transaction_id, i, ticket.ticket_id, True)
 
-        for ref in tx.references:
-            if ref.asset_group_id == self.service_id:
-                self.delete_utxo(ref.transaction_id, ref.event_index_in_ref)
+    def invalidate_signer_cache(self, user_id=None):
+        if user_id is None:
+            self.signer_cache.clear()
+        else:
+            self.signer_cache.pop(user_id)
+
+
+    def is_valid(self, ticket_id, eval_time):
+        rows = self.exec_sql(
+            ('select t.rowid from ticket_table t '
+             'join ticket_attribute_table a '
+             'on t.ticket_id=a.ticket_id where '
+             't.service_id=? and t.ticket_id=? and t.user_id!=? and '
+             't.state!=? and a.time_of_begin<=? and a.time_of_end>? limit 1'),
+            self.service_id,
+            ticket_id,
+            self.service_id,
+            ST_TAKEN,
+            eval_time,
+            eval_time
+        )
+        return len(rows) > 0
 
 
     def is_valid_holder(self, user_id, ticket_id, eval_time=None):
-        rows = self.read_utxo(user_id, ticket_id)
+        if eval_time is None:
+            rows = self.read_utxo(user_id, ticket_id)
+        else:
+            rows = self.exec_sql(
+                ('select t.rowid from ticket_table t '
+                 'join ticket_attribute_table a '
+                 'on t.ticket_id=a.ticket_id where '
+                 't.service_id=? and t.user_id=? and t.ticket_id=? and '
+                 't.state=? and a.time_of_begin<=? and a.time_of_end>? '
+                 'limit 1'),
+                self.service_id,
+                user_id,
+                ticket_id,
+                ST_FREE,
+                eval_time,
+                eval_time
+            )
         return len(rows) > 0
 
 
-    def push_tx(self, tx_id, tx):
+    def iter_utxos(self, user_id, page_size=DEFAULT_PAGE_SIZE,
+            with_tickets=False):
+        after = 0
+        while True:
+            rows = self.read_utxo_page(user_id, after, page_size)
+            for row in rows:
+                if with_tickets:
+                    yield row + (self.get_ticket(row[3]),)
+                else:
+                    yield row
+            if len(rows) < page_size:
+                return
+            after = rows[-1][0]
 
-        Store.lock.acquire()
 
-        rows = self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
-            'select rowid from ticket_tx_id_table where tx_id=?',
-            tx_id
-        )
+    def migrate(self):
+        rows = self.exec_sql('select version from ticket_schema_table')
         if len(rows) <= 0:
-            self.db.exec_sql(
-                self.domain_id,
-                NAME_OF_DB,
-                'insert into ticket_tx_id_table values (?, ?)',
-                tx_id,
-                bbclib.serialize(tx)
-            )
+            self.exec_sql('insert into ticket_schema_table values (0)')
+            version = 0
+        else:
+            version = rows[0][0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError('database schema is newer than the library')
 
-        Store.lock.release()
+        for i in range(version, SCHEMA_VERSION):
+            self.begin()
+            try:
+                for step in SCHEMA_MIGRATIONS[i]:
+                    if callable(step):
+                        step(self)
+                    else:
+                        self.exec_sql(step)
+                self.exec_sql('update ticket_schema_table set version=?',
+                        i + 1)
+            except:
+                self.rollback()
+                raise
+            self.commit()
+
+
+    def push_tx(self, tx_id, tx):
+        self.exec_sql(
+            'insert or ignore into ticket_tx_id_table values (?, ?, 0)',
+            tx_id,
+            bbclib.serialize(tx)
+        )
+        self.tx_cache.put(tx_id, tx)
 
 
     def put_ticket(self, ticket_id, ticket):
+        obj = TicketView(ticket)
+        spec = bytes(obj.view[obj.ptr + TICKET_HEAD.size:
+                obj.tail_ptr + SPEC_TAIL.size])
+        spec_id = hashlib.sha256(spec).digest()
+        self.exec_sql(
+            'insert or ignore into ticket_spec_table values (?, ?)',
+            spec_id,
+            spec
+        )
+        self.exec_sql(
+            'insert or ignore into ticket_id_table values (?, ?, ?, ?)',
+            ticket_id,
+            None,
+            spec_id,
+            obj.time_of_origin
+        )
+        time_of_begin, time_of_end = obj.get_time_interval()
+        self.exec_sql(
+            ('insert or ignore into ticket_attribute_table values '
+             '(?, ?, ?, ?, ?, ?)'),
+            ticket_id,
+            obj.unit,
+            obj.value,
+            obj.book_of,
+            time_of_begin,
+            time_of_end
+        )
 
-        Store.lock.acquire()
 
-        rows = self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
-            'select rowid from ticket_id_table where ticket_id=?',
-            ticket_id
+    def read_tx(self, tx_id):
+        rows = self.exec_sql(
+            'select tx from ticket_tx_id_table where tx_id=?',
+            tx_id
         )
         if len(rows) <= 0:
-            self.db.exec_sql(
-                self.domain_id,
-                NAME_OF_DB,
-                'insert into ticket_id_table values (?, ?)',
-                ticket_id,
-                ticket
-            )
+            return None
+        tx, fmt = bbclib.deserialize(rows[0][0])
+        return tx
+
 
-        Store.lock.release()
+    def read_usable_utxos(self, user_id, ticket_ids):
+        utxos = []
+        for ticket_id in ticket_ids:
+            rows = self.read_utxo(user_id, ticket_id)
+            if len(rows) <= 0:
+                raise ValueError('no usable event')
+            utxos.append((rows[0][IDX_TX_ID], rows[0][IDX_EVENT_IDX]))
+        return utxos
 
 
     def read_utxo(self, user_id, ticket_id):
-        return self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
+        return self.exec_sql(
             ('select * from ticket_table where '
              'service_id=? and user_id=? and ticket_id=? and state=?'),
             self.service_id,
@@ -524,10 +1407,22 @@ class Store:
         )
 
 
+    def read_utxo_page(self, user_id, after=0, page_size=DEFAULT_PAGE_SIZE):
+        # keyset pagination; pass the last rowid seen as after.
+        return self.exec_sql(
+            ('select rowid, tx_id, event_idx, ticket_id, uses from '
+             'ticket_table where service_id=? and user_id=? and state=? and '
+             'rowid>? order by rowid limit ?'),
+            self.service_id,
+            user_id,
+            ST_FREE,
+            after,
+            page_size
+        )
+
+
     def read_utxo_list(self, user_id):
-        return self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
+        return self.exec_sql(
             ('select * from ticket_table where '
              'service_id=? and user_id=? and state=?'),
             self.service_id,
@@ -536,10 +1431,36 @@ class Store:
         )
 
 
+    def read_valid_utxo_list(self, user_id, eval_time):
+        return self.exec_sql(
+            ('select t.* from ticket_table t join ticket_attribute_table a '
+             'on t.ticket_id=a.ticket_id where '
+             't.service_id=? and t.user_id=? and t.state=? and '
+             'a.time_of_begin<=? and a.time_of_end>?'),
+            self.service_id,
+            user_id,
+            ST_FREE,
+            eval_time,
+            eval_time
+        )
+
+
+    def reclaim_reservations(self, lease, eval_time=None):
+        if eval_time is None:
+            eval_time = int(time.time())
+        return self.exec_sql(
+            ('update ticket_table set state=?, last_modified=? where '
+             'state=? and last_modified<=? and service_id=?'),
+            ST_FREE,
+            eval_time,
+            ST_RESERVED,
+            eval_time - lease,
+            self.service_id
+        )
+
+
     def reserve_utxo(self, tx_id, idx):
-        return self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
+        return self.exec_sql(
             ('update ticket_table set state=?, last_modified=? where '
              'tx_id=? and event_idx=?'),
             ST_RESERVED,
@@ -555,6 +1476,13 @@ class Store:
                 self.reserve_utxo(ref.transaction_id, ref.event_index_in_ref)
 
 
+    def rollback(self):
+        try:
+            self.exec_sql('rollback')
+        finally:
+            self.lock.release()
+
+
     def sign(self, transaction, user_id, keypair):
         sig = transaction.sign(
                 private_key=keypair.private_key,
@@ -570,52 +1498,421 @@ class Store:
         return transaction
 
 
-    def take_tx(self, tx_id):
-        rows = self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
-            'select tx from ticket_tx_id_table where tx_id=?',
-            tx_id
-        )
-        if len(rows) <= 0:
-            return None
-        tx, fmt = bbclib.deserialize(rows[0][0])
-        return tx
+    def sign_and_submit(self, transaction, user_id, keypair, idPublickeyMap,
+            callback=None):
+        self.sign(transaction, user_id, keypair)
+        transaction.digest()
+        return self.submit_insert(transaction, user_id, idPublickeyMap,
+                callback)
 
 
-    def write_utxo(self, user_id, tx_id, idx, ticket_id, is_single):
+    def submit_insert(self, tx, user_id, idPublickeyMap, callback=None,
+            verified=False):
+        if not verified and not self.verify_signers(tx, user_id,
+                idPublickeyMap):
+            raise RuntimeError('signers not verified')
 
-        Store.lock.acquire()
+        self.push_tx(tx.transaction_id, tx)
 
-        rows = self.db.exec_sql(
-            self.domain_id,
-            NAME_OF_DB,
-            'select rowid from ticket_table where tx_id=? and event_idx=?',
-            tx_id,
-            idx
+        # blocks while insert_window transactions are outstanding.
+        self.insert_window.acquire()
+        try:
+            response = self.app.callback.request(self.app.insert_transaction,
+                    tx)
+        except:
+            self.insert_window.release()
+            raise
+
+        future = concurrent.futures.Future()
+
+        def completed(response):
+            self.insert_window.release()
+            if response.exception() is not None:
+                future.set_exception(response.exception())
+                return
+            res = response.result()
+            if res[KeyType.status] < ESUCCESS:
+                future.set_exception(
+                        RuntimeError(res[KeyType.reason].decode()))
+            else:
+                future.set_result(tx)
+
+        response.add_done_callback(completed)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+
+    def sweep_expired(self, eval_time, batch_size=DEFAULT_SWEEP_BATCH_SIZE):
+        self.begin()
+        try:
+            # cross join makes the expiry index drive the query, instead
+            # of walking every ticket of the service.
+            rows = self.exec_sql(
+                ('select t.rowid, t.user_id, t.ticket_id, t.uses from '
+                 'ticket_attribute_table a cross join ticket_table t '
+                 'on a.ticket_id=t.ticket_id where '
+                 'a.time_of_end<=? and t.service_id=? and t.state=? '
+                 'order by a.time_of_end limit ?'),
+                eval_time,
+                self.service_id,
+                ST_FREE,
+                batch_size
+            )
+            for rowid, user_id, ticket_id, uses in rows:
+                self.exec_sql(
+                    ('update ticket_table set state=?, last_modified=? where '
+                     'rowid=?'),
+                    ST_EXPIRED,
+                    int(time.time()),
+                    rowid
+                )
+                self.update_balance(user_id, ticket_id, -1, uses)
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        return len(rows)
+
+
+    def take_tx(self, tx_id):
+        # a committed transaction stays as the local copy for get_local_tx.
+        if self.exec_write(
+            ('update ticket_tx_id_table set is_committed=1 where '
+             'tx_id=? and is_committed is not 1'),
+            tx_id
+        ) <= 0:
+            return None
+        tx = self.tx_cache.get(tx_id)
+        if tx is None:
+            tx = self.read_tx(tx_id)
+            self.tx_cache.put(tx_id, tx)
+        return tx
+
+
+    def update_balance(self, user_id, ticket_id, sign, uses=None):
+        rows = self.exec_sql(
+            ('select unit, value, book_of, time_of_end from '
+             'ticket_attribute_table where ticket_id=?'),
+            ticket_id
         )
         if len(rows) <= 0:
-            self.db.exec_sql(
-                self.domain_id,
-                NAME_OF_DB,
-                'insert into ticket_table values (?, ?, ?, ?, ?, ?, ?, ?)',
+            return
+        unit, value, book_of, time_of_end = rows[0]
+        if uses is None:
+            uses = book_of
+
+        with self.lock:
+            self.exec_sql(
+                ('insert or ignore into ticket_balance_table values '
+                 '(?, ?, ?, ?, 0)'),
                 self.service_id,
                 user_id,
-                tx_id,
-                idx,
-                ticket_id,
-                is_single,
-                ST_FREE,
-                int(time.time())
+                unit,
+                time_of_end
+            )
+            self.exec_sql(
+                ('update ticket_balance_table set value=value+? where '
+                 'service_id=? and user_id=? and unit=? and time_of_end=?'),
+                sign * value * uses,
+                self.service_id,
+                user_id,
+                unit,
+                time_of_end
             )
 
-        Store.lock.release()
+            # tickets held by the service itself are redeemed, not supplied.
+            if user_id != self.service_id:
+                bucket = time_of_end // SUPPLY_BUCKET_SECONDS
+                self.exec_sql(
+                    ('insert or ignore into ticket_supply_table values '
+                     '(?, ?, ?, 0)'),
+                    self.service_id,
+                    unit,
+                    bucket
+                )
+                self.exec_sql(
+                    ('update ticket_supply_table set value=value+? where '
+                     'service_id=? and unit=? and bucket=?'),
+                    sign * value * uses,
+                    self.service_id,
+                    unit,
+                    bucket
+                )
+
+
+    def verify_many(self, txs, user_id, idPublickeyMap,
+            batch_size=DEFAULT_VERIFY_BATCH):
+        results = [None] * len(txs)
+        cached = []
+        for i, tx in enumerate(txs):
+            items = self.get_cached_signatures(tx, user_id)
+            if items is None:
+                results[i] = self.verify_signers(tx, user_id, idPublickeyMap)
+            else:
+                cached.append((i, items))
+
+        batches = [cached[i:i + batch_size]
+                for i in range(0, len(cached), batch_size)]
+        if self.verify_pool is None:
+            verified = [verify_signatures_batch([items for _, items in batch])
+                    for batch in batches]
+        else:
+            verified = self.verify_pool.map(verify_signatures_batch,
+                    [[items for _, items in batch] for batch in batches])
+        for batch, flags in zip(batches, verified):
+            for (i, _), flag in zip(batch, flags):
+                results[i] = flag
+        return results
+
+
+    def verify_signers(self, tx, user_id, idPublickeyMap):
+        items = self.get_cached_signatures(tx, user_id)
+        if items is not None:
+            return verify_signatures(items)
+
+        if idPublickeyMap.verify_signers(tx, self.service_id,
+                user_id) == False:
+            return False
+        self.cache_signers(tx)
+        return True
+
+
+    def write_utxo(self, user_id, tx_id, idx, ticket_id, is_single,
+            uses=None):
+        # duplicates are dropped by the unique key on (tx_id, event_idx).
+        return self.exec_write(
+            'insert or ignore into ticket_table values ' + UTXO_ROW,
+            self.service_id,
+            user_id,
+            tx_id,
+            idx,
+            ticket_id,
+            is_single,
+            ST_FREE,
+            int(time.time()),
+            uses
+        ) > 0
+
+
+    def write_utxos(self, tx_id, utxos):
+        # returns the utxos that were not written before.
+        if not HAS_RETURNING:
+            return [(user_id, idx, ticket_id, uses)
+                    for user_id, idx, ticket_id, uses in utxos
+                    if self.write_utxo(user_id, tx_id, idx, ticket_id, True,
+                            uses)]
+
+        written = set()
+        now = int(time.time())
+        for i in range(0, len(utxos), UTXO_INSERT_CHUNK):
+            chunk = utxos[i:i + UTXO_INSERT_CHUNK]
+            params = []
+            for user_id, idx, ticket_id, uses in chunk:
+                params.extend((self.service_id, user_id, tx_id, idx,
+                        ticket_id, True, ST_FREE, now, uses))
+            rows = self.exec_sql(
+                ('insert or ignore into ticket_table values {0} '
+                 'returning event_idx').format(
+                        ', '.join([UTXO_ROW] * len(chunk))),
+                *params
+            )
+            written.update(row[0] for row in rows)
+        return [utxo for utxo in utxos if utxo[1] in written]
+
+
+class ExpirySweeper(threading.Thread):
+
+    def __init__(self, store, interval, batch_size=DEFAULT_SWEEP_BATCH_SIZE,
+            lease=DEFAULT_RESERVATION_LEASE, logger=None):
+        super().__init__(daemon=True)
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lease = lease
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.swept = 0
+
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = int(time.time())
+            try:
+                self.sweep(now)
+                wait = self.interval
+                next_expiry = self.store.get_next_expiry(now)
+                if next_expiry is not None:
+                    wait = max(min(wait, next_expiry - now), 0)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error('expiry sweep failed: %s' % e)
+                wait = self.interval
+            self.stopped.wait(wait)
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+    def sweep(self, eval_time):
+        if self.lease is not None:
+            self.store.reclaim_reservations(self.lease, eval_time)
+
+        # release the store lock between batches to keep other writers moving.
+        while not self.stopped.is_set():
+            count = self.store.sweep_expired(eval_time, self.batch_size)
+            self.swept += count
+            if count < self.batch_size:
+                break
+
+
+class SigningEngine:
+
+    def __init__(self, service, workers=DEFAULT_SIGNING_WORKERS,
+            max_batch=DEFAULT_SIGNING_BATCH):
+        self.service = service
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.lock = threading.Lock()
+        self.signed = 0
+        self.denied = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+
+    def deny(self, item, reason):
+        received, dat = item
+        self.service.app.callback.send(
+                self.service.app.sendback_denial_of_sign,
+                dat[KeyType.source_user_id], reason_text=reason,
+                query_id=dat.get(KeyType.query_id))
+        self.record(received, denied=True)
+
+
+    def process(self, batch, answered):
+        # only this thread sends; the workers just sign.
+        keypair = self.service.app.callback.keypair
+        if keypair is None:
+            for item in batch:
+                self.deny(item, 'keypair is unset')
+                answered.add(id(item))
+            return
+
+        results = list(self.pool.map(lambda item: self.sign(item, keypair),
+                batch))
+
+        store = self.service.store
+        store.begin()
+        try:
+            for _, _, tx, _ in results:
+                store.reserve_referred_utxos(tx)
+                store.push_tx(tx.transaction_id, tx)
+        except:
+            store.rollback()
+            raise
+        store.commit()
+
+        for item, (received, dat, tx, sig) in zip(batch, results):
+            self.service.app.callback.send(
+                    self.service.app.sendback_signature,
+                    dat[KeyType.source_user_id], tx.transaction_id, -1, sig,
+                    query_id=dat.get(KeyType.query_id))
+            answered.add(id(item))
+            self.record(received)
+
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+
+    def record(self, received, denied=False):
+        latency = time.time() - received
+        with self.lock:
+            if denied:
+                self.denied += 1
+            else:
+                self.signed += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            answered = set()
+            try:
+                self.process(batch, answered)
+            except Exception as e:
+                self.service.logger.error('signing failed: %s' % e)
+                for item in batch:
+                    if id(item) not in answered:
+                        self.deny(item, 'signing failed')
+
+
+    def sign(self, item, keypair):
+        received, dat = item
+        tx, fmt = bbclib.deserialize(dat[KeyType.transaction_data])
+
+        # FIXME: check validity
+
+        sig = self.service.store.sign(tx, self.service.user_id, keypair)
+        tx.digest()
+        return received, dat, tx, sig
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stats(self):
+        with self.lock:
+            count = self.signed + self.denied
+            return {
+                'queue_depth': self.queue.qsize(),
+                'signed': self.signed,
+                'denied': self.denied,
+                'latency_avg': self.latency_total / count if count > 0
+                        else 0.0,
+                'latency_max': self.latency_max,
+            }
+
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.pool.shutdown()
+
+
+    def submit(self, dat):
+        self.queue.put((time.time(), dat))
 
 
 class BBcTicketService:
 
     def __init__(self, domain_id, service_id, user_id, idPublickeyMap,
-            port=DEFAULT_CORE_PORT, logname="-", loglevel="none"):
+            port=DEFAULT_CORE_PORT, logname="-", loglevel="none",
+            tx_cache_size=DEFAULT_TX_CACHE_SIZE,
+            ticket_cache_size=DEFAULT_TICKET_CACHE_SIZE,
+            spec_cache_size=DEFAULT_SPEC_CACHE_SIZE,
+            insert_window=DEFAULT_INSERT_WINDOW, verify_workers=None,
+            sweep_interval=None, sweep_batch_size=DEFAULT_SWEEP_BATCH_SIZE,
+            reservation_lease=DEFAULT_RESERVATION_LEASE,
+            signing_workers=None, signing_batch=DEFAULT_SIGNING_BATCH):
         self.logger = logger.get_logger(key="ticket_lib", level=loglevel,
                                         logname=logname) # FIXME: use logger
         self.domain_id = domain_id
@@ -630,27 +1927,104 @@ class BBcTicketService:
         ret = self.app.register_to_core()
         assert ret
 
-        self.store = Store(self.domain_id, self.service_id, self.app)
+        self.store = Store(self.domain_id, self.service_id, self.app,
+                tx_cache_size=tx_cache_size,
+                ticket_cache_size=ticket_cache_size,
+                spec_cache_size=spec_cache_size,
+                insert_window=insert_window, verify_workers=verify_workers)
         self.app.request_insert_completion_notification(self.service_id)
 
+        self.sweeper = None
+        if sweep_interval is not None:
+            self.start_sweeper(sweep_interval, sweep_batch_size,
+                    reservation_lease)
+
+        self.signing_engine = None
+        if signing_workers is not None:
+            self.start_signing_engine(signing_workers, signing_batch)
+
+
+    def approve_and_insert(self, tx, user_id, keypair_user=None,
+            keypair_service=None):
+        if keypair_user is None:
+            return tx
+
+        if keypair_service is None:
+            self.gather_signatures(tx, [self.service_id])
+            return self.store.sign_and_insert(tx, user_id, keypair_user,
+                    self.idPublickeyMap)
+
+        self.store.sign(tx, user_id, keypair_user)
+
+        return self.store.sign_and_insert(tx, self.service_id, keypair_service,
+                self.idPublickeyMap)
+
+
+    def check_transferable(self, ticket_ids):
+        if len(ticket_ids) <= 0:
+            raise ValueError('no ticket to transfer')
+        if len(set(ticket_ids)) != len(ticket_ids):
+            raise ValueError('duplicate tickets')
+
+        for ticket_id in ticket_ids:
+            ticket = self.store.get_ticket(ticket_id)
+            if ticket is None:
+                raise TypeError('ticket does not exist')
+            if not ticket.is_transferable():
+                raise TypeError('ticket is not transferable')
+
 
     def close(self):
-        self.app.unregister_from_core()
+        self.stop_signing_engine()
+        self.stop_sweeper()
+        self.app.callback.send(self.app.unregister_from_core)
         self.store.close()
 
 
+    def gather_signatures(self, tx, destinations):
+        # one request is answered by each destination in turn, or by a
+        # single error if the core fails to forward it.
+        if self.user_id in destinations:
+            raise ValueError('cannot gather a signature from oneself')
+        self.app.callback.send(self.app.gather_signatures, tx,
+                destinations=destinations)
+        for i in range(len(destinations)):
+            res = self.app.callback.synchronize(
+                    timeout=self.app.callback.request_timeout)
+            if res is None:
+                raise RuntimeError('timed out gathering signatures')
+            if res[KeyType.status] < ESUCCESS:
+                raise RuntimeError(res[KeyType.reason].decode())
+            _, user_id, sig = res[KeyType.result]
+            tx.add_signature_object(user_id, signature=sig)
+
+
     def get_balance_of(self, user_id, eval_time=None):
         if eval_time is None:
             eval_time = int(time.time())
         return self.store.get_balance_of(user_id, eval_time)
 
 
-    def get_total_supply(self, time):
-        pass
+    def get_balances_of(self, user_ids, eval_time=None):
+        if eval_time is None:
+            eval_time = int(time.time())
+        return self.store.get_balances_of(user_ids, eval_time)
+
+
+    def get_total_supply(self, eval_time=None):
+        if eval_time is None:
+            eval_time = int(time.time())
+        return self.store.get_total_supply(eval_time)
+
+
+    def invalidate_signer_cache(self, user_id=None):
+        self.store.invalidate_signer_cache(user_id)
 
 
     def is_valid(self, ticket_id, eval_time=None):
-        pass
+        if eval_time is None:
+            eval_time = int(time.time())
+        return self.store.is_valid(ticket_id, eval_time)
 
 
     def is_valid_holder(self, user_id, ticket_id, eval_time=None):
@@ -659,33 +2033,72 @@ class BBcTicketService:
 
     def issue(self, to_user_id, spec, time_of_origin=None, keypair=None,
             label=None):
+        ticket_ids, txs = self.issue_many([(to_user_id, spec)],
+                time_of_origin=time_of_origin, keypair=keypair, label=label)
+        return ticket_ids[0], txs[0]
+
+
+    def issue_many(self, recipients_and_specs, time_of_origin=None,
+            keypair=None, label=None, events_per_tx=MAX_EVENTS_PER_TX):
         if self.user_id != self.service_id:
             raise RuntimeError('issuer must be the ticket service')
+        if events_per_tx <= 0:
+            raise ValueError('events_per_tx must be positive')
+
+        recipients_and_specs = list(recipients_and_specs)
+        ticket_ids = []
+        txs = []
+        futures = []
+
+        for base in range(0, len(recipients_and_specs), events_per_tx):
+            chunk = recipients_and_specs[base:base + events_per_tx]
+            tx = bbclib.make_transaction(event_num=len(chunk))
+            origin = tx.timestamp if time_of_origin is None \
+                    else time_of_origin
+
+            for event, (to_user_id, spec) in zip(tx.events, chunk):
+                event.asset_group_id = self.service_id
+                event.asset.add(user_id=to_user_id,
+                        asset_body=Ticket(
+                        spec=spec, time_of_origin=origin).serialize())
+                ticket_ids.append(event.asset.asset_id)
+                # FIXME: check collision of ticket_id
+
+                event.add(mandatory_approver=self.service_id)
+                event.add(mandatory_approver=to_user_id)
+
+            if label is not None:
+                tx.add(event=label.get_event())
+
+            tx.add(witness=bbclib.BBcWitness())
+            tx.witness.add_witness(self.service_id)
+
+            if keypair is not None:
+                self.store.sign(tx, self.service_id, keypair)
+                tx.digest()
+            txs.append(tx)
 
-        tx = bbclib.make_transaction(event_num=1)
-        tx.events[0].asset_group_id = self.service_id
-        if time_of_origin is None:
-            time_of_origin = tx.timestamp
-        tx.events[0].asset.add(user_id=to_user_id,
-                asset_body=Ticket(
-                spec=spec, time_of_origin=time_of_origin).serialize())
-        ticket_id = tx.events[0].asset.asset_id
-        # FIXME: check collision of ticket_id
+        if keypair is None:
+            return ticket_ids, txs
 
-        tx.events[0].add(mandatory_approver=self.service_id)
-        tx.events[0].add(mandatory_approver=to_user_id)
+        verified = self.store.verify_many(txs, self.service_id,
+                self.idPublickeyMap)
+        if not all(verified):
+            raise RuntimeError('signers not verified')
 
-        if label is not None:
-            tx.add(event=label.get_event())
+        for tx in txs:
+            futures.append(self.store.submit_insert(tx, self.service_id,
+                    self.idPublickeyMap, verified=True))
 
-        tx.add(witness=bbclib.BBcWitness())
-        tx.witness.add_witness(self.service_id)
+        for future in futures:
+            future.result()
 
-        if keypair is None:
-            return ticket_id, tx
+        return ticket_ids, txs
 
-        return ticket_id, self.store.sign_and_insert(tx, self.service_id,
-                keypair, self.idPublickeyMap)
+
+    def iter_holdings(self, user_id, page_size=DEFAULT_PAGE_SIZE,
+            with_tickets=False):
+        return self.store.iter_utxos(user_id, page_size, with_tickets)
 
 
     def make_event(self, ref_indices, user_id, ticket):
@@ -699,38 +2112,77 @@ class BBcTicketService:
         return event
 
 
-    def redeem(self, from_user_id, ticket_id, transaction=None,
-            keypair_from=None, keypair_service=None, label=None):
-        tx = self.transfer(from_user_id, self.service_id, ticket_id,
-                transaction, keypair_from, keypair_service, label=label)
-        return tx
+    def make_split(self, ticket_id, parts, event, transaction=None,
+            label=None):
+        ref_tx, index = event
+        if TicketView(ref_tx.events[index].asset.asset_body).uses \
+                is not None:
+            raise ValueError('book is partially used')
+        stored = self.store.get_ticket(ticket_id)
+        ticket = Ticket(ticket_id=ticket_id, spec=stored.spec,
+                time_of_origin=stored.time_of_origin)
+        successors = ticket.split([value for _, value in parts])
 
+        if transaction is None:
+            tx = bbclib.BBcTransaction()
+            base_refs = 0
+        else:
+            tx = transaction
+            base_refs = len(tx.references)
 
-    def set_keypair(self, keypair):
-       self.app.callback.set_keypair(keypair)
+        ref = bbclib.BBcReference(asset_group_id=self.service_id,
+                transaction=tx, ref_transaction=ref_tx,
+                event_index_in_ref=index)
+        tx.add(reference=ref)
+        ticket_ids = []
+        for (to_user_id, _), successor in zip(parts, successors):
+            event = self.make_event([base_refs], to_user_id, successor)
+            tx.add(event=event)
+            ticket_ids.append(event.asset.asset_id)
 
+        if label is not None:
+            tx.add(event=label.get_event())
 
-    def sign_and_insert(self, transaction, user_id, keypair):
-        return self.store.sign_and_insert(transaction, user_id, keypair,
-                self.idPublickeyMap)
+        return ticket_ids, tx
 
 
-    def split(self, ticket_id):
-        pass
+    def make_transfer(self, to_user_id, ticket_ids, events, transaction=None,
+            label=None):
+        if transaction is None:
+            tx = bbclib.BBcTransaction()
+            base_refs = 0
+        else:
+            tx = transaction
+            base_refs = len(tx.references)
 
+        for i, (ticket_id, (ref_tx, index)) in enumerate(zip(ticket_ids,
+                events)):
+            ref = bbclib.BBcReference(asset_group_id=self.service_id,
+                    transaction=tx, ref_transaction=ref_tx,
+                    event_index_in_ref=index)
+            tx.add(reference=ref)
+            # a book carries its remaining uses over to the recipient.
+            uses = TicketView(ref_tx.events[index].asset.asset_body).uses
+            ticket = Ticket(ticket_id=ticket_id, uses=uses)
+            tx.add(event=self.make_event([base_refs + i], to_user_id,
+                    ticket))
 
-    def swap(self, ticket_id):
-        pass
+        if label is not None:
+            tx.add(event=label.get_event())
 
+        return tx
 
-    def transfer(self, from_user_id, to_user_id, ticket_id, transaction=None,
-            keypair_from=None, keypair_service=None, label=None):
 
-        ticket = self.store.get_ticket(ticket_id)
-        if ticket is None:
-            raise TypeError('ticket does not exist')
-        if not ticket.is_transferable():
-            raise TypeError('ticket is not transferable')
+    def make_redemption(self, user_id, ticket_id, event, uses,
+            transaction=None, label=None):
+        ref_tx, index = event
+        ticket = Ticket(ticket_id=ticket_id,
+                spec=self.store.get_ticket(ticket_id).spec,
+                uses=TicketView(ref_tx.events[index].asset.asset_body).uses)
+        successor = ticket.redeem(uses)
+        if successor.uses <= 0:
+            return self.make_transfer(self.service_id, [ticket_id], [event],
+                    transaction, label)
 
         if transaction is None:
             tx = bbclib.BBcTransaction()
@@ -739,35 +2191,322 @@ class BBcTicketService:
             tx = transaction
             base_refs = len(tx.references)
 
-        ref_tx, index = self.store.get_usable_event(from_user_id, ticket_id)
-
         ref = bbclib.BBcReference(asset_group_id=self.service_id,
                 transaction=tx, ref_transaction=ref_tx,
                 event_index_in_ref=index)
         tx.add(reference=ref)
-        ticket = Ticket(ticket_id=ticket_id)
-        tx.add(event=self.make_event([base_refs], to_user_id, ticket))
+        tx.add(event=self.make_event([base_refs], user_id, successor))
 
         if label is not None:
             tx.add(event=label.get_event())
 
-        if keypair_from is None:
+        return tx
+
+
+    def redeem(self, from_user_id, ticket_id, transaction=None,
+            keypair_from=None, keypair_service=None, label=None, uses=None):
+        if uses is None:
+            return self.transfer(from_user_id, self.service_id, ticket_id,
+                    transaction, keypair_from, keypair_service, label=label)
+
+        events = self.store.get_usable_events(from_user_id, [ticket_id])
+        tx = self.make_redemption(from_user_id, ticket_id, events[0], uses,
+                transaction, label)
+        return self.approve_and_insert(tx, from_user_id, keypair_from,
+                keypair_service)
+
+
+    def set_keypair(self, keypair):
+       self.app.callback.set_keypair(keypair)
+
+
+    def sign_and_insert(self, transaction, user_id, keypair):
+        return self.store.sign_and_insert(transaction, user_id, keypair,
+                self.idPublickeyMap)
+
+
+    def split(self, from_user_id, ticket_id, parts, transaction=None,
+            keypair_from=None, keypair_service=None, label=None):
+        parts = list(parts)
+        if any(to_user_id != from_user_id for to_user_id, _ in parts):
+            self.check_transferable([ticket_id])
+        events = self.store.get_usable_events(from_user_id, [ticket_id])
+        ticket_ids, tx = self.make_split(ticket_id, parts, events[0],
+                transaction, label)
+        return ticket_ids, self.approve_and_insert(tx, from_user_id,
+                keypair_from, keypair_service)
+
+
+    def start_signing_engine(self, workers=DEFAULT_SIGNING_WORKERS,
+            max_batch=DEFAULT_SIGNING_BATCH):
+        self.stop_signing_engine()
+        self.signing_engine = SigningEngine(self, workers, max_batch)
+        self.signing_engine.start()
+        self.app.callback.set_signing_engine(self.signing_engine)
+
+
+    def start_sweeper(self, interval, batch_size=DEFAULT_SWEEP_BATCH_SIZE,
+            lease=DEFAULT_RESERVATION_LEASE):
+        self.stop_sweeper()
+        self.sweeper = ExpirySweeper(self.store, interval, batch_size,
+                lease=lease, logger=self.logger)
+        self.sweeper.start()
+
+
+    def stop_signing_engine(self):
+        if self.signing_engine is not None:
+            self.app.callback.set_signing_engine(None)
+            self.signing_engine.stop()
+            self.signing_engine = None
+
+
+    def stop_sweeper(self):
+        if self.sweeper is not None:
+            self.sweeper.stop()
+            self.sweeper.join()
+            self.sweeper = None
+
+
+    def swap(self, user_a_id, ticket_a_id, user_b_id, ticket_b_id,
+            transaction=None, keypair_a=None, keypair_b=None,
+            keypair_service=None, label=None):
+        if user_a_id == user_b_id:
+            raise ValueError('cannot swap with oneself')
+        self.check_transferable([ticket_a_id, ticket_b_id])
+        events_a = self.store.get_usable_events(user_a_id, [ticket_a_id])
+        events_b = self.store.get_usable_events(user_b_id, [ticket_b_id])
+        tx = self.make_transfer(user_b_id, [ticket_a_id], events_a,
+                transaction)
+        tx = self.make_transfer(user_a_id, [ticket_b_id], events_b, tx,
+                label)
+
+        signers = [(user_a_id, keypair_a), (user_b_id, keypair_b),
+                (self.service_id, keypair_service)]
+        local = [signer for signer in signers if signer[1] is not None]
+        if len(local) <= 0:
+            return tx
+
+        remote = [user_id for user_id, keypair in signers if keypair is None]
+        if self.user_id in remote:
+            raise ValueError('keypair of the requesting user is required')
+        if len(remote) > 0:
+            self.gather_signatures(tx, remote)
+        for user_id, keypair in local[:-1]:
+            self.store.sign(tx, user_id, keypair)
+        user_id, keypair = local[-1]
+        return self.store.sign_and_insert(tx, user_id, keypair,
+                self.idPublickeyMap)
+
+
+    def transfer(self, from_user_id, to_user_id, ticket_id, transaction=None,
+            keypair_from=None, keypair_service=None, label=None):
+        return self.transfer_many(from_user_id, to_user_id, [ticket_id],
+                transaction, keypair_from, keypair_service, label=label)
+
+
+    def transfer_many(self, from_user_id, to_user_id, ticket_ids,
+            transaction=None, keypair_from=None, keypair_service=None,
+            label=None):
+        self.check_transferable(ticket_ids)
+        events = self.store.get_usable_events(from_user_id, ticket_ids)
+        tx = self.make_transfer(to_user_id, ticket_ids, events, transaction,
+                label)
+        return self.approve_and_insert(tx, from_user_id, keypair_from,
+                keypair_service)
+
+
+class AsyncTicketService:
+
+    def __init__(self, domain_id, service_id, user_id, idPublickeyMap,
+            port=DEFAULT_CORE_PORT, logname="-", loglevel="none", **kwargs):
+        self.service = BBcTicketService(domain_id, service_id, user_id,
+                idPublickeyMap, port=port, logname=logname,
+                loglevel=loglevel, **kwargs)
+        self.service_id = service_id
+        self.idPublickeyMap = idPublickeyMap
+        self.app = self.service.app
+        self.store = self.service.store
+
+
+    async def approve_and_insert(self, tx, user_id, keypair_user=None,
+            keypair_service=None):
+        if keypair_user is None:
             return tx
 
         if keypair_service is None:
-            self.app.gather_signatures(tx, destinations=[self.service_id])
-            res = self.app.callback.synchronize()
-            if res[KeyType.status] < ESUCCESS:
-                raise RuntimeError(res[KeyType.reason].decode())
-            result = res[KeyType.result]
-            tx.add_signature_object(self.service_id, signature=result[2])
-            return self.store.sign_and_insert(tx, from_user_id, keypair_from,
-                    self.idPublickeyMap)
+            await self.gather_signatures(tx, [self.service_id])
+            return await self.sign_and_insert(tx, user_id, keypair_user)
 
-        self.store.sign(tx, from_user_id, keypair_from)
+        self.store.sign(tx, user_id, keypair_user)
 
-        return self.store.sign_and_insert(tx, self.service_id, keypair_service,
-                self.idPublickeyMap)
+        return await self.sign_and_insert(tx, self.service_id,
+                keypair_service)
+
+
+    def close(self):
+        self.service.close()
+
+
+    async def gather_signatures(self, tx, destinations):
+        if self.service.user_id in destinations:
+            raise ValueError('cannot gather a signature from oneself')
+        futures = self.app.callback.request_many(len(destinations),
+                self.app.gather_signatures, tx, destinations=destinations)
+
+        # responses fill the futures in order; an error may be the only one.
+        async def collect():
+            results = []
+            for future in futures:
+                res = await asyncio.wrap_future(future)
+                if res[KeyType.status] < ESUCCESS:
+                    raise RuntimeError(res[KeyType.reason].decode())
+                results.append(res)
+            return results
+
+        try:
+            results = await asyncio.wait_for(collect(),
+                    self.app.callback.request_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError('timed out gathering signatures')
+        for res in results:
+            sig = bbclib.recover_signature_object(res[KeyType.signature])
+            tx.add_signature_object(res[KeyType.source_user_id],
+                    signature=sig)
+
+
+    async def get_tx(self, tx_id):
+        loop = asyncio.get_event_loop()
+        tx = await loop.run_in_executor(None, self.store.get_local_tx, tx_id)
+        if tx is not None:
+            return tx
+
+        res = await self.request(self.app.search_transaction, tx_id)
+        if res[KeyType.status] < ESUCCESS:
+            raise ValueError('not found')
+        tx, fmt = bbclib.deserialize(res[KeyType.transaction_data])
+
+        self.store.tx_cache.put(tx_id, tx)
+        return tx
+
+
+    async def get_usable_events(self, user_id, ticket_ids):
+        loop = asyncio.get_event_loop()
+        utxos = await loop.run_in_executor(None, self.store.read_usable_utxos,
+                user_id, ticket_ids)
+        txs = dict()
+        events = []
+        for tx_id, index in utxos:
+            if tx_id not in txs:
+                txs[tx_id] = await self.get_tx(tx_id)
+            events.append((txs[tx_id], index))
+        return events
+
+
+    async def insert(self, tx, user_id):
+        # submitting may block for verification or a full insert window.
+        loop = asyncio.get_event_loop()
+        future = await loop.run_in_executor(None, self.store.submit_insert,
+                tx, user_id, self.idPublickeyMap)
+        await asyncio.wait_for(asyncio.wrap_future(future),
+                self.app.callback.request_timeout)
+
+
+    async def is_valid_holder(self, user_id, ticket_id, eval_time=None):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.store.is_valid_holder,
+                user_id, ticket_id, eval_time)
+
+
+    async def issue(self, to_user_id, spec, time_of_origin=None,
+            keypair=None, label=None):
+        ticket_id, tx = self.service.issue(to_user_id, spec,
+                time_of_origin=time_of_origin, label=label)
+
+        if keypair is None:
+            return ticket_id, tx
+
+        return ticket_id, await self.sign_and_insert(tx, self.service_id,
+                keypair)
+
+
+    async def redeem(self, from_user_id, ticket_id, transaction=None,
+            keypair_from=None, keypair_service=None, label=None, uses=None):
+        if uses is None:
+            return await self.transfer(from_user_id, self.service_id,
+                    ticket_id, transaction, keypair_from, keypair_service,
+                    label=label)
+
+        events = await self.get_usable_events(from_user_id, [ticket_id])
+        loop = asyncio.get_event_loop()
+        tx = await loop.run_in_executor(None, self.service.make_redemption,
+                from_user_id, ticket_id, events[0], uses, transaction, label)
+        return await self.approve_and_insert(tx, from_user_id, keypair_from,
+                keypair_service)
+
+
+    async def request(self, send, *args, **kwargs):
+        future = self.app.callback.request(send, *args, **kwargs)
+        return await asyncio.wait_for(asyncio.wrap_future(future),
+                self.app.callback.request_timeout)
+
+
+    async def sign_and_insert(self, transaction, user_id, keypair):
+        self.store.sign(transaction, user_id, keypair)
+        transaction.digest()
+        await self.insert(transaction, user_id)
+        return transaction
+
+
+    async def swap(self, user_a_id, ticket_a_id, user_b_id, ticket_b_id,
+            transaction=None, keypair_a=None, keypair_b=None,
+            keypair_service=None, label=None):
+        if user_a_id == user_b_id:
+            raise ValueError('cannot swap with oneself')
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.service.check_transferable,
+                [ticket_a_id, ticket_b_id])
+        events_a = await self.get_usable_events(user_a_id, [ticket_a_id])
+        events_b = await self.get_usable_events(user_b_id, [ticket_b_id])
+        tx = self.service.make_transfer(user_b_id, [ticket_a_id], events_a,
+                transaction)
+        tx = self.service.make_transfer(user_a_id, [ticket_b_id], events_b,
+                tx, label)
+
+        signers = [(user_a_id, keypair_a), (user_b_id, keypair_b),
+                (self.service_id, keypair_service)]
+        local = [signer for signer in signers if signer[1] is not None]
+        if len(local) <= 0:
+            return tx
+
+        remote = [user_id for user_id, keypair in signers if keypair is None]
+        if self.service.user_id in remote:
+            raise ValueError('keypair of the requesting user is required')
+        if len(remote) > 0:
+            await self.gather_signatures(tx, remote)
+        for user_id, keypair in local[:-1]:
+            self.store.sign(tx, user_id, keypair)
+        user_id, keypair = local[-1]
+        return await self.sign_and_insert(tx, user_id, keypair)
+
+
+    async def transfer(self, from_user_id, to_user_id, ticket_id,
+            transaction=None, keypair_from=None, keypair_service=None,
+            label=None):
+        return await self.transfer_many(from_user_id, to_user_id, [ticket_id],
+                transaction, keypair_from, keypair_service, label=label)
+
+
+    async def transfer_many(self, from_user_id, to_user_id, ticket_ids,
+            transaction=None, keypair_from=None, keypair_service=None,
+            label=None):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.service.check_transferable,
+                ticket_ids)
+        events = await self.get_usable_events(from_user_id, ticket_ids)
+        tx = self.service.make_transfer(to_user_id, ticket_ids, events,
+                transaction, label)
+        return await self.approve_and_insert(tx, from_user_id, keypair_from,
+                keypair_service)
 
 
 class ServiceCallback(bbc_app.Callback):
@@ -776,14 +2515,46 @@ class ServiceCallback(bbc_app.Callback):
         super().__init__(logger)
         self.service = service
         self.keypair = None
+        self.signing_engine = None
+        self.futures = OrderedDict()
+        self.futures_lock = threading.Lock()
+        self.send_lock = threading.RLock()
+        self.sending = False
+        self.early = []
+        self.request_timeout = DEFAULT_REQUEST_TIMEOUT
+
+
+    def expire(self):
+        # called with futures_lock held; deadlines are in insertion order.
+        expired = []
+        now = time.time()
+        while len(self.futures) > 0:
+            query_id, (deadline, futures) = next(iter(self.futures.items()))
+            if deadline > now:
+                break
+            del self.futures[query_id]
+            expired.extend(futures)
+        return expired
+
+
+    def fail(self, futures, exception):
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exception)
 
 
     def proc_cmd_sign_request(self, dat):
+        if self.signing_engine is not None:
+            self.signing_engine.submit(dat)
+            return
+
         source_user_id = dat[KeyType.source_user_id]
 
         if self.keypair is None:
-            self.service.app.sendback_denial_of_sign(source_user_id,
-                    'keypair is unset')
+            self.send(self.service.app.sendback_denial_of_sign,
+                    source_user_id, reason_text='keypair is unset',
+                    query_id=dat.get(KeyType.query_id))
+            return
 
         tx, fmt = bbclib.deserialize(dat[KeyType.transaction_data])
 
@@ -794,16 +2565,92 @@ class ServiceCallback(bbc_app.Callback):
 
         self.service.store.reserve_referred_utxos(tx)
         self.service.store.push_tx(tx.transaction_id, tx)
-        self.service.app.sendback_signature(source_user_id, tx.transaction_id,
-                -1, sig)
+        self.send(self.service.app.sendback_signature, source_user_id,
+                tx.transaction_id, -1, sig,
+                query_id=dat.get(KeyType.query_id))
 
 
     def proc_notify_inserted(self, dat):
         self.service.store.inserted(dat[KeyType.transaction_id])
 
 
+    def proc_resp_gather_signature(self, dat):
+        self.resolve(dat, super().proc_resp_gather_signature)
+
+
+    def proc_resp_insert(self, dat):
+        self.resolve(dat, super().proc_resp_insert)
+
+
+    def proc_resp_search_transaction(self, dat):
+        self.resolve(dat, super().proc_resp_search_transaction)
+
+
+    def request(self, send, *args, **kwargs):
+        return self.request_many(1, send, *args, **kwargs)[0]
+
+
+    def request_many(self, count, send, *args, **kwargs):
+        futures = [concurrent.futures.Future() for i in range(count)]
+        query_id = None
+        # send_lock keeps the query_id returned by send() ours; responses
+        # arriving before it is registered are held back by resolve().
+        with self.send_lock:
+            with self.futures_lock:
+                self.sending = True
+            try:
+                query_id = send(*args, **kwargs)
+            finally:
+                with self.futures_lock:
+                    self.sending = False
+                    expired = self.expire()
+                    if query_id is not None and query_id != False:
+                        if query_id in self.futures:
+                            expired.extend(self.futures.pop(query_id)[1])
+                        self.futures[query_id] = (
+                                time.time() + self.request_timeout,
+                                list(futures))
+                    early = self.early
+                    self.early = []
+
+        self.fail(expired, TimeoutError('no response from the core'))
+        for dat, handler in early:
+            self.resolve(dat, handler)
+        if query_id is None or query_id == False:
+            raise RuntimeError('failed to send a request')
+        return futures
+
+
+    def resolve(self, dat, handler):
+        query_id = dat.get(KeyType.query_id)
+        future = None
+        with self.futures_lock:
+            entry = self.futures.get(query_id)
+            if entry is None and self.sending:
+                self.early.append((dat, handler))
+                return
+            if entry is not None:
+                futures = entry[1]
+                future = futures.pop(0)
+                if len(futures) <= 0:
+                    del self.futures[query_id]
+        if future is None:
+            handler(dat)
+        elif future.set_running_or_notify_cancel():
+            future.set_result(dat)
+
+
+    def send(self, func, *args, **kwargs):
+        with self.send_lock:
+            return func(*args, **kwargs)
+
+
     def set_keypair(self, keypair):
         self.keypair = keypair
 
 
+    def set_signing_engine(self, signing_engine):
+        self.signing_engine = signing_engine
+
+
 # end of ticket_lib.py
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import hashlib
+import msgpack
 import sys
+import threading
 import time
 
 sys.path.extend(["../"])
@@ -10,6 +13,7 @@ from bbc1.core import bbclib
 from bbc1.core.bbc_config import DEFAULT_CORE_PORT
 from bbc1.lib import id_lib, ticket_lib
 from bbc1.lib.app_support_lib import TransactionLabel
+from bbclib.libs import bbclib_binary
 
 domain_id = None
 service_id = None
@@ -353,6 +357,114 @@ def test_ticket():
     assert ticket.time_of_origin is None
 
 
+def test_ticket_codec():
+
+    def reference(spec, time_of_origin):
+        dat = bytearray(bbclib_binary.to_1byte(ticket_lib.Ticket.T_TICKET))
+        dat.extend(bbclib_binary.to_2byte(spec.version))
+        if isinstance(spec.description, str):
+            t = ticket_lib.Constants.DESC_STRING
+            raw = spec.description.encode()
+        elif isinstance(spec.description, dict):
+            t = ticket_lib.Constants.DESC_DICTIONARY
+            raw = msgpack.dumps(spec.description, use_bin_type=True)
+        else:
+            t = ticket_lib.Constants.DESC_BINARY
+            raw = spec.description
+        dat.extend(bbclib_binary.to_1byte(t))
+        dat.extend(bbclib_binary.to_2byte(len(raw)))
+        dat.extend(raw)
+        unit = spec.unit.encode()
+        dat.extend(bbclib_binary.to_1byte(len(unit)))
+        dat.extend(unit)
+        dat.extend(bbclib_binary.to_8byte(spec.value))
+        dat.extend(bbclib_binary.to_2byte(spec.book_of))
+        dat.extend(bbclib_binary.to_8byte(spec.time_to_begin))
+        dat.extend(bbclib_binary.to_8byte(spec.time_to_end))
+        dat.extend(bbclib_binary.to_8byte(spec.expire_after))
+        options = ticket_lib.Constants.O_BIT_NONE
+        if spec.option_divisible:
+            options |= ticket_lib.Constants.O_BIT_DIVISIBLE
+        if spec.option_transferable:
+            options |= ticket_lib.Constants.O_BIT_TRANSFERABLE
+        if spec.option_relative_time:
+            options |= ticket_lib.Constants.O_BIT_RELATIVE_TIME
+        dat.extend(bbclib_binary.to_2byte(options))
+        dat.extend(bbclib_binary.to_8byte(time_of_origin))
+        return bytes(dat)
+
+    for description in ["Nozomi 41:ShinYokohama:Kyoto:Car 9:Seat 13A",
+            {'train': 'Nozomi 41', 'car': 9, 'seat': '13A'},
+            b"\x00\x01binary\xff"]:
+        spec = ticket_lib.TicketSpec(description=description, value=270,
+                unit="yen", book_of=12, time_to_begin=3600,
+                time_to_end=1552895220, expire_after=86400,
+                option_divisible=True, option_relative_time=True)
+        ticket = ticket_lib.Ticket(spec=spec, time_of_origin=1552885200)
+
+        dat = ticket.serialize()
+        assert dat == reference(spec, 1552885200)
+
+        ptr, ticket = ticket_lib.Ticket.from_serialized_data(0, dat)
+        assert ptr == len(dat)
+        assert ticket.spec == spec
+        assert ticket.time_of_origin == 1552885200
+
+        ticket_id = hashlib.sha256(dat).digest()
+        ticket = ticket_lib.Ticket(ticket_id=ticket_id)
+        dat = ticket.serialize()
+        assert dat == bbclib_binary.to_1byte(ticket_lib.Ticket.T_TICKET_ID) \
+                + bbclib_binary.to_bigint(ticket_id)
+
+        _, ticket = ticket_lib.Ticket.from_serialized_data(0,
+                bytearray(dat))
+        assert ticket.ticket_id == ticket_id
+
+    spec = None
+    try:
+        ticket_lib.Ticket.from_serialized_data(0, b'\x07')
+    except TypeError:
+        spec = 1
+    assert spec == 1
+
+
+def test_ticket_view():
+
+    description = {'train': 'Nozomi 41', 'car': 9, 'seat': '13A'}
+    spec = ticket_lib.TicketSpec(description=description, value=1,
+            unit="person", book_of=1, time_to_begin=3600,
+            time_to_end=7200, expire_after=600, option_transferable=True,
+            option_relative_time=True)
+    ticket = ticket_lib.Ticket(spec=spec, time_of_origin=1552885200)
+    dat = ticket.serialize()
+
+    ptr, view = ticket_lib.TicketView.from_serialized_data(0, dat)
+
+    assert ptr == len(dat)
+    assert view.ticket_id is None
+    assert view.is_transferable()
+    assert not view.is_divisible()
+    assert view.is_relative_time()
+    assert view.get_time_interval() == ticket.get_time_interval()
+    assert view.unit == "person"
+    assert view.value == 1
+    assert view.description == description
+    assert view.spec == spec
+    assert view.time_of_origin == 1552885200
+    assert view.serialize() == dat
+
+    ticket_id = hashlib.sha256(dat).digest()
+    view.ticket_id = ticket_id
+    dat = view.serialize()
+    assert dat == ticket_lib.Ticket(ticket_id=ticket_id).serialize()
+
+    view = ticket_lib.TicketView(dat)
+
+    assert view.ticket_id == ticket_id
+    assert view.spec is None
+    assert view.time_of_origin is None
+
+
 def test_ticket_attributes():
 
     description = "SpecialExpress:Nozomi 41:ShinYokohama:Kyoto:Car 9:Seat 13A"
@@ -406,6 +518,38 @@ def test_ticket_attributes():
     assert not ticket.is_relative_time()
 
 
+def test_lru_cache():
+
+    cache = ticket_lib.LRUCache(2)
+
+    assert cache.get(b'a') is None
+    assert cache.misses == 1
+
+    cache.put(b'a', 1)
+    cache.put(b'b', 2)
+
+    assert cache.get(b'a') == 1
+    assert cache.hits == 1
+
+    cache.put(b'c', 3)
+
+    assert len(cache) == 2
+    assert b'a' in cache
+    assert b'b' not in cache
+    assert cache.get(b'c') == 3
+
+    stats = cache.stats()
+
+    assert stats['capacity'] == 2
+    assert stats['size'] == 2
+    assert stats['evictions'] == 1
+
+    cache = ticket_lib.LRUCache(0)
+    cache.put(b'a', 1)
+
+    assert len(cache) == 0
+
+
 def test_service():
 
     service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
@@ -458,6 +602,1078 @@ def test_service():
     assert label.get_label_id(tx) == label.label_id
 
 
+def test_issue_many():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    ticket_spec_dict = {
+        'description': "Denki Groove:Zepp Tokyo:Standing:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+    }
+
+    spec = ticket_lib.TicketSpec(ticket_spec_dict)
+
+    recipients_and_specs = [
+        (user_a_id, spec),
+        (user_b_id, spec),
+        (user_a_id, spec),
+    ]
+
+    ticket_ids, txs = service.issue_many(recipients_and_specs,
+            time_of_origin=1552600000, keypair=keypairs[0], events_per_tx=2)
+
+    assert len(ticket_ids) == 3
+    assert len(txs) == 2
+    assert len(txs[0].events) == 2
+    assert len(txs[1].events) == 1
+
+    assert txs[0].events[0].asset.asset_id == ticket_ids[0]
+    assert txs[0].events[1].asset.asset_id == ticket_ids[1]
+    assert txs[1].events[0].asset.asset_id == ticket_ids[2]
+
+    assert service.is_valid_holder(user_a_id, ticket_ids[0])
+    assert service.is_valid_holder(user_b_id, ticket_ids[1])
+    assert service.is_valid_holder(user_a_id, ticket_ids[2])
+    assert not service.is_valid_holder(user_b_id, ticket_ids[0])
+
+    service.close()
+
+
+def test_transfer_many():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    ticket_spec_dict = {
+        'description': "Yokohama Municipal Subway:Group:Adult",
+        'value': 270,
+        'unit': "yen",
+    }
+
+    spec = ticket_lib.TicketSpec(ticket_spec_dict)
+
+    ticket_ids, _ = service.issue_many([(user_a_id, spec)] * 3,
+            time_of_origin=1552600000, keypair=keypairs[0])
+
+    tx = service.transfer_many(user_a_id, user_b_id, ticket_ids,
+            keypair_from=keypairs_a[0], keypair_service=keypairs[0])
+
+    assert len(tx.references) == 3
+    assert len(tx.events) == 3
+
+    for ticket_id in ticket_ids:
+        assert service.is_valid_holder(user_b_id, ticket_id)
+        assert not service.is_valid_holder(user_a_id, ticket_id)
+
+    try:
+        service.transfer_many(user_b_id, user_a_id,
+                [ticket_ids[0], ticket_ids[0]],
+                keypair_from=keypairs_b[0], keypair_service=keypairs[0])
+    except ValueError:
+        spec = 10
+
+    assert spec == 10
+
+    service.close()
+
+
+def test_balance():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec_short = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+        'time_to_end': 1552700000,
+    })
+    spec_book = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway Off-Peak Multiple",
+        'value': 270,
+        'unit': "yen",
+        'book_of': 12,
+        'time_to_end': 1560000000,
+    })
+    spec_seat = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:S3-16:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+        'time_to_end': 1560000000,
+    })
+
+    ticket_ids, _ = service.issue_many([
+        (user_a_id, spec_short),
+        (user_a_id, spec_book),
+        (user_a_id, spec_seat),
+    ], time_of_origin=1552600000, keypair=keypairs[0])
+
+    balance = service.get_balance_of(user_a_id, eval_time=1552650000)
+
+    assert balance == {'yen': 830 + 270 * 12, 'person': 1}
+
+    balance = service.get_balance_of(user_a_id, eval_time=1552700000)
+
+    assert balance == {'yen': 270 * 12, 'person': 1}
+
+    service.transfer(user_a_id, user_b_id, ticket_ids[2],
+            keypair_from=keypairs_a[0], keypair_service=keypairs[0])
+
+    assert service.get_balance_of(user_a_id, eval_time=1552700000) \
+            == {'yen': 270 * 12}
+    assert service.get_balance_of(user_b_id, eval_time=1552700000) \
+            == {'person': 1}
+    assert service.get_balance_of(user_b_id, eval_time=1560000000) == {}
+
+    service.close()
+
+
+def test_balances_of():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_ids = [idPubkeyMap.create_user_id(num_pubkeys=1)[0]
+            for i in range(3)]
+
+    spec_book = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway Off-Peak Multiple",
+        'value': 270,
+        'unit': "yen",
+        'book_of': 12,
+        'time_to_end': 1560000000,
+    })
+    spec_seat = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:S3-16:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+        'time_to_end': 1552700000,
+    })
+
+    service.issue_many([
+        (user_ids[0], spec_book),
+        (user_ids[0], spec_seat),
+        (user_ids[1], spec_seat),
+        (user_ids[1], spec_seat),
+    ], time_of_origin=1552600000, keypair=keypairs[0])
+
+    balances = service.get_balances_of(user_ids, eval_time=1552650000)
+
+    assert balances == {
+        user_ids[0]: {'yen': 270 * 12, 'person': 1},
+        user_ids[1]: {'person': 2},
+        user_ids[2]: {},
+    }
+    for user_id in user_ids:
+        assert balances[user_id] == service.get_balance_of(user_id,
+                eval_time=1552650000)
+
+    balances = service.get_balances_of(user_ids, eval_time=1552700000)
+
+    assert balances[user_ids[0]] == {'yen': 270 * 12}
+    assert balances[user_ids[1]] == {}
+
+    service.close()
+
+
+def test_redeem_uses():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway Off-Peak Multiple",
+        'value': 270,
+        'unit': "yen",
+        'book_of': 12,
+        'time_to_end': 1560000000,
+    })
+
+    ticket_id, _ = service.issue(user_a_id, spec,
+            time_of_origin=1552600000, keypair=keypairs[0])
+
+    tx = service.redeem(user_a_id, ticket_id, keypair_from=keypairs_a[0],
+            keypair_service=keypairs[0], uses=3)
+
+    assert len(tx.references) == 1
+    assert len(tx.events) == 1
+    _, ticket = ticket_lib.Ticket.from_serialized_data(0,
+            tx.events[0].asset.asset_body)
+    assert ticket.ticket_id == ticket_id
+    assert ticket.uses == 9
+
+    assert service.is_valid_holder(user_a_id, ticket_id)
+    assert service.get_balance_of(user_a_id, eval_time=1552650000) \
+            == {'yen': 270 * 9}
+    assert service.store.read_utxo(user_a_id,
+            ticket_id)[0][ticket_lib.IDX_USES] == 9
+
+    spec = None
+    try:
+        service.redeem(user_a_id, ticket_id, keypair_from=keypairs_a[0],
+                keypair_service=keypairs[0], uses=10)
+    except ValueError:
+        spec = 1
+    assert spec == 1
+
+    service.redeem(user_a_id, ticket_id, keypair_from=keypairs_a[0],
+            keypair_service=keypairs[0], uses=9)
+
+    assert not service.is_valid_holder(user_a_id, ticket_id)
+    assert service.get_balance_of(user_a_id, eval_time=1552650000) == {}
+
+    service.close()
+
+
+def test_split():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Group Admission:Sankeien Garden",
+        'value': 40,
+        'unit': "person",
+        'time_to_end': 1560000000,
+        'option_divisible': True,
+    })
+    spec_single = ticket_lib.TicketSpec({
+        'description': "Admission:Sankeien Garden",
+        'value': 1,
+        'unit': "person",
+        'time_to_end': 1560000000,
+    })
+
+    ticket_ids, _ = service.issue_many([
+        (user_a_id, spec),
+        (user_a_id, spec_single),
+    ], time_of_origin=1552600000, keypair=keypairs[0])
+
+    spec = None
+    try:
+        service.split(user_a_id, ticket_ids[0],
+                [(user_a_id, 10), (user_b_id, 20)],
+                keypair_from=keypairs_a[0], keypair_service=keypairs[0])
+    except ValueError:
+        spec = 1
+    assert spec == 1
+
+    spec = None
+    try:
+        service.split(user_a_id, ticket_ids[1],
+                [(user_a_id, 1), (user_b_id, 1)],
+                keypair_from=keypairs_a[0], keypair_service=keypairs[0])
+    except TypeError:
+        spec = 2
+    assert spec == 2
+
+    new_ids, tx = service.split(user_a_id, ticket_ids[0],
+            [(user_a_id, 10), (user_b_id, 30)],
+            keypair_from=keypairs_a[0], keypair_service=keypairs[0])
+
+    assert len(new_ids) == 2
+    assert len(tx.references) == 1
+    assert len(tx.events) == 2
+
+    assert not service.is_valid_holder(user_a_id, ticket_ids[0])
+    assert service.is_valid_holder(user_a_id, new_ids[0])
+    assert service.is_valid_holder(user_b_id, new_ids[1])
+    assert service.store.get_ticket(new_ids[1]).spec.value == 30
+    assert service.get_balance_of(user_a_id, eval_time=1552650000) \
+            == {'person': 10 + 1}
+    assert service.get_balance_of(user_b_id, eval_time=1552650000) \
+            == {'person': 30}
+
+    service.close()
+
+
+def test_swap():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+    service.set_keypair(keypairs[0])
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    client_a = ticket_lib.BBcTicketService(domain_id, service_id, user_a_id,
+            idPubkeyMap)
+    client_b = ticket_lib.BBcTicketService(domain_id, service_id, user_b_id,
+            idPubkeyMap)
+    client_b.set_keypair(keypairs_b[0])
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:S3-19:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+    })
+
+    ticket_ids, _ = service.issue_many([
+        (user_a_id, spec),
+        (user_b_id, spec),
+        (user_b_id, spec),
+    ], time_of_origin=1552600000, keypair=keypairs[0])
+
+    spec = None
+    try:
+        client_a.swap(user_a_id, ticket_ids[0], user_a_id, ticket_ids[1])
+    except ValueError:
+        spec = 1
+    assert spec == 1
+
+    spec = None
+    try:
+        client_a.swap(user_a_id, ticket_ids[0], user_b_id, ticket_ids[1],
+                keypair_b=keypairs_b[0])
+    except ValueError:
+        spec = 1
+    assert spec == 1
+
+    tx = client_a.swap(user_a_id, ticket_ids[0], user_b_id, ticket_ids[1],
+            keypair_a=keypairs_a[0])
+
+    assert len(tx.references) == 2
+    assert len(tx.events) == 2
+
+    assert service.is_valid_holder(user_b_id, ticket_ids[0])
+    assert service.is_valid_holder(user_a_id, ticket_ids[1])
+    assert not service.is_valid_holder(user_a_id, ticket_ids[0])
+    assert not service.is_valid_holder(user_b_id, ticket_ids[1])
+
+    service.swap(user_a_id, ticket_ids[1], user_b_id, ticket_ids[2],
+            keypair_a=keypairs_a[0], keypair_b=keypairs_b[0],
+            keypair_service=keypairs[0])
+
+    assert service.is_valid_holder(user_b_id, ticket_ids[1])
+    assert service.is_valid_holder(user_a_id, ticket_ids[2])
+
+    client_b.close()
+    client_a.close()
+    service.close()
+
+
+def test_holdings():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+    })
+
+    ticket_ids, _ = service.issue_many([(user_a_id, spec)] * 5,
+            time_of_origin=1552600000, keypair=keypairs[0])
+
+    rows = service.store.read_utxo_page(user_a_id, page_size=2)
+
+    assert [row[3] for row in rows] == ticket_ids[:2]
+
+    rows = service.store.read_utxo_page(user_a_id, rows[-1][0], 2)
+
+    assert [row[3] for row in rows] == ticket_ids[2:4]
+
+    service.transfer(user_a_id, user_b_id, ticket_ids[1],
+            keypair_from=keypairs_a[0], keypair_service=keypairs[0])
+
+    rows = list(service.iter_holdings(user_a_id, page_size=2))
+
+    assert [row[3] for row in rows] == ticket_ids[:1] + ticket_ids[2:]
+
+    rows = list(service.iter_holdings(user_b_id, with_tickets=True))
+
+    assert len(rows) == 1
+    assert rows[0][3] == ticket_ids[1]
+    assert rows[0][5].spec == spec
+
+    service.close()
+
+
+def test_total_supply():
+
+    service_id_supply, keypairs_supply = idPubkeyMap.create_user_id(
+            num_pubkeys=1)
+    service = ticket_lib.BBcTicketService(domain_id, service_id_supply,
+            service_id_supply, idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec_short = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+        'time_to_end': 1552700000,
+    })
+    spec_long = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:Commuter Pass",
+        'value': 12000,
+        'unit': "yen",
+        'time_to_end': 1560000000,
+    })
+
+    ticket_ids, _ = service.issue_many([
+        (user_a_id, spec_short),
+        (user_a_id, spec_long),
+    ], time_of_origin=1552600000, keypair=keypairs_supply[0])
+
+    assert service.get_total_supply(1552650000) == {'yen': 830 + 12000}
+    assert service.get_total_supply(1552699999) == {'yen': 830 + 12000}
+    assert service.get_total_supply(1552700000) == {'yen': 12000}
+    assert service.get_total_supply(1560000000) == {}
+
+    service.redeem(user_a_id, ticket_ids[1], keypair_from=keypairs_a[0],
+            keypair_service=keypairs_supply[0])
+
+    assert service.get_total_supply(1552650000) == {'yen': 830}
+
+    service.close()
+
+
+def test_validity():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec_absolute = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:S3-16:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+        'time_to_begin': 1552644000,
+        'time_to_end': 1552654800,
+    })
+    spec_relative = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+        'time_to_begin': 60 * 60,
+        'time_to_end': 60 * 60 * 24 * 365,
+        'expire_after': 60 * 60 * 24,
+        'option_relative_time': True,
+    })
+
+    ticket_ids, _ = service.issue_many([
+        (user_a_id, spec_absolute),
+        (user_a_id, spec_relative),
+    ], time_of_origin=1552600000, keypair=keypairs[0])
+
+    assert not service.is_valid(ticket_ids[0], eval_time=1552643999)
+    assert service.is_valid(ticket_ids[0], eval_time=1552644000)
+    assert not service.is_valid(ticket_ids[0], eval_time=1552654800)
+
+    assert not service.is_valid(ticket_ids[1], eval_time=1552600000)
+    assert service.is_valid(ticket_ids[1], eval_time=1552603600)
+    assert not service.is_valid(ticket_ids[1], eval_time=1552686400)
+
+    assert service.is_valid_holder(user_a_id, ticket_ids[0])
+    assert service.is_valid_holder(user_a_id, ticket_ids[0],
+            eval_time=1552650000)
+    assert not service.is_valid_holder(user_a_id, ticket_ids[0],
+            eval_time=1552660000)
+
+    rows = service.store.read_valid_utxo_list(user_a_id, 1552650000)
+
+    assert len(rows) == 2
+
+    rows = service.store.read_valid_utxo_list(user_a_id, 1552660000)
+
+    assert len(rows) == 1
+    assert rows[0][ticket_lib.IDX_TICKET_ID] == ticket_ids[1]
+
+    service.redeem(user_a_id, ticket_ids[1], keypair_from=keypairs_a[0],
+            keypair_service=keypairs[0])
+
+    assert not service.is_valid(ticket_ids[1], eval_time=1552603600)
+
+    service.close()
+
+
+def test_sweep_expired():
+
+    service_id_sweep, keypairs_sweep = idPubkeyMap.create_user_id(
+            num_pubkeys=1)
+    service = ticket_lib.BBcTicketService(domain_id, service_id_sweep,
+            service_id_sweep, idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec_short = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+        'time_to_end': 1552700000,
+    })
+    spec_long = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:Commuter Pass",
+        'value': 12000,
+        'unit': "yen",
+    })
+
+    ticket_ids, _ = service.issue_many([
+        (user_a_id, spec_short),
+        (user_a_id, spec_short),
+        (user_a_id, spec_short),
+        (user_a_id, spec_long),
+    ], time_of_origin=1552600000, keypair=keypairs_sweep[0])
+
+    sweeper = ticket_lib.ExpirySweeper(service.store, 60, batch_size=2)
+    sweeper.sweep(1552700000)
+
+    assert sweeper.swept == 3
+    assert service.store.sweep_expired(1552700000) == 0
+
+    assert len(service.store.read_utxo_list(user_a_id)) == 1
+    assert not service.is_valid_holder(user_a_id, ticket_ids[0])
+    assert service.is_valid_holder(user_a_id, ticket_ids[3])
+    assert service.get_balance_of(user_a_id, eval_time=1552600000) \
+            == {'yen': 12000}
+    assert service.get_total_supply(1552600000) == {'yen': 12000}
+
+    service.close()
+
+
+def test_reclaim_reservations():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:S3-17:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+    })
+
+    ticket_id, _ = service.issue(user_a_id, spec, time_of_origin=1552600000,
+            keypair=keypairs[0])
+
+    tx = service.transfer(user_a_id, user_b_id, ticket_id)
+    service.store.reserve_referred_utxos(tx)
+
+    assert not service.is_valid_holder(user_a_id, ticket_id)
+
+    now = int(time.time())
+    service.store.reclaim_reservations(60, eval_time=now)
+
+    assert not service.is_valid_holder(user_a_id, ticket_id)
+
+    service.store.reclaim_reservations(60, eval_time=now + 60)
+
+    assert service.is_valid_holder(user_a_id, ticket_id)
+
+    service.close()
+
+
+def test_async_service():
+
+    service = ticket_lib.AsyncTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:Standing:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+    })
+
+    async def run():
+        issued = await asyncio.gather(*[
+            service.issue(user_a_id, spec, time_of_origin=1552600000,
+                    keypair=keypairs[0]) for i in range(5)
+        ])
+        ticket_ids = [ticket_id for ticket_id, _ in issued]
+
+        for ticket_id in ticket_ids:
+            assert await service.is_valid_holder(user_a_id, ticket_id)
+
+        await asyncio.gather(*[
+            service.transfer(user_a_id, user_b_id, ticket_id,
+                    keypair_from=keypairs_a[0], keypair_service=keypairs[0])
+                    for ticket_id in ticket_ids
+        ])
+
+        for ticket_id in ticket_ids:
+            assert await service.is_valid_holder(user_b_id, ticket_id)
+            assert not await service.is_valid_holder(user_a_id, ticket_id)
+
+        await service.redeem(user_b_id, ticket_ids[0],
+                keypair_from=keypairs_b[0], keypair_service=keypairs[0])
+
+        assert await service.is_valid_holder(service_id, ticket_ids[0])
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run())
+    loop.close()
+
+    service.close()
+
+
+def test_submit_insert():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap, insert_window=2)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:Standing:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+    })
+
+    completed = []
+    futures = []
+    ticket_ids = []
+
+    for i in range(5):
+        ticket_id, tx = service.issue(user_a_id, spec,
+                time_of_origin=1552600000)
+        ticket_ids.append(ticket_id)
+        futures.append(service.store.sign_and_submit(tx, service_id,
+                keypairs[0], idPubkeyMap,
+                callback=lambda f: completed.append(f.result())))
+
+    for future in futures:
+        assert future.result(timeout=30) is not None
+
+    assert len(completed) == 5
+
+    service.close()
+
+
+def test_signing_engine():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap, signing_workers=2)
+    service.set_keypair(keypairs[0])
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user_b_id, keypairs_b = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    client = ticket_lib.BBcTicketService(domain_id, service_id, user_a_id,
+            idPubkeyMap)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:S3-18:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+    })
+
+    ticket_id, _ = service.issue(user_a_id, spec, time_of_origin=1552600000,
+            keypair=keypairs[0])
+
+    client.transfer(user_a_id, user_b_id, ticket_id,
+            keypair_from=keypairs_a[0])
+
+    assert service.is_valid_holder(user_b_id, ticket_id)
+
+    stats = service.signing_engine.stats()
+
+    assert stats['signed'] == 1
+    assert stats['denied'] == 0
+    assert stats['queue_depth'] == 0
+
+    client.close()
+    service.close()
+
+
+def test_signer_cache():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap, verify_workers=2)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Denki Groove:Zepp Tokyo:Standing:Open 1552640400",
+        'value': 1,
+        'unit': "person",
+    })
+
+    _, txs = service.issue_many([(user_a_id, spec)] * 4,
+            time_of_origin=1552600000, events_per_tx=1)
+    for tx in txs:
+        service.store.sign(tx, service_id, keypairs[0])
+        tx.digest()
+
+    assert service.store.get_cached_signatures(txs[0], service_id) is None
+    assert service.store.verify_signers(txs[0], service_id, idPubkeyMap)
+    assert service.store.get_cached_signatures(txs[0], service_id) \
+            is not None
+
+    assert service.store.verify_many(txs, service_id, idPubkeyMap) \
+            == [True] * 4
+
+    txs[1].signatures[0].signature = bytes(len(
+            txs[1].signatures[0].signature))
+
+    assert service.store.verify_many(txs, service_id, idPubkeyMap) \
+            == [True, False, True, True]
+
+    service.store.signer_cache_ttl = 0
+    time.sleep(0.01)
+
+    assert service.store.get_cached_signatures(txs[0], service_id) is None
+
+    service.store.signer_cache_ttl = ticket_lib.DEFAULT_SIGNER_CACHE_TTL
+
+    assert service.store.get_cached_signatures(txs[0], service_id) \
+            is not None
+
+    service.invalidate_signer_cache(service_id)
+
+    assert service.store.get_cached_signatures(txs[0], service_id) is None
+
+    service.close()
+
+
+def test_spec_dedup():
+
+    service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,
+            idPubkeyMap)
+
+    user_a_id, keypairs_a = idPubkeyMap.create_user_id(num_pubkeys=1)
+
+    spec = ticket_lib.TicketSpec({
+        'description': {'tour': "Ultra Tour", 'hall': "Zepp Tokyo"},
+        'value': 1,
+        'unit': "person",
+    })
+    spec_id = hashlib.sha256(spec.serialize()).digest()
+
+    ticket_ids, _ = service.issue_many([(user_a_id, spec)] * 3,
+            time_of_origin=1552600000, keypair=keypairs[0])
+
+    rows = service.store.exec_sql(
+            'select count(*) from ticket_spec_table where spec_id=?',
+            spec_id)
+    assert rows[0][0] == 1
+
+    rows = service.store.exec_sql(
+            'select ticket, spec_id from ticket_id_table where ticket_id=?',
+            ticket_ids[0])
+    assert rows[0][0] is None
+    assert rows[0][1] == spec_id
+
+    service.store.ticket_cache.clear()
+    tickets = [service.store.get_ticket(ticket_id)
+            for ticket_id in ticket_ids]
+
+    assert tickets[0].spec == spec
+    assert tickets[0].spec is tickets[1].spec
+    assert tickets[1].spec is tickets[2].spec
+    assert tickets[2].time_of_origin == 1552600000
+
+    service.close()
+
+
+def test_query_plan():
+
+    store = ticket_lib.Store(domain_id, service_id, None)
+
+    rows = store.exec_sql(
+            'select version from ticket_schema_table')
+    assert rows[0][0] == ticket_lib.SCHEMA_VERSION
+
+    rows = store.exec_sql(
+            ("select name from sqlite_master where "
+             "type='index' and tbl_name='ticket_table'"))
+    assert set(row[0] for row in rows) == {'ticket_table_free_page',
+            'ticket_table_holder', 'ticket_table_lease',
+            'ticket_table_ticket', 'ticket_table_utxo_key'}
+
+    exec_sql = store.exec_sql
+    statements = []
+
+    def record(sql, *args):
+        statements.append((sql, args))
+        return exec_sql(sql, *args)
+
+    store.exec_sql = record
+
+    user_id = bbclib.get_new_id("query plan user")
+    ticket_id = bbclib.get_new_id("query plan ticket")
+    tx_id = bbclib.get_new_id("query plan tx")
+
+    store.read_utxo(user_id, ticket_id)
+    store.read_utxo_list(user_id)
+    store.read_utxo_page(user_id)
+    store.read_valid_utxo_list(user_id, 1552650000)
+    store.write_utxo(user_id, tx_id, 0, ticket_id, True)
+    store.write_utxos(tx_id, [(user_id, 1, ticket_id, None)])
+    store.reserve_utxo(tx_id, 1)
+    store.delete_utxo(tx_id, 0)
+    store.get_balances_of([user_id])
+    store.is_valid(ticket_id, 1552650000)
+    store.is_valid_holder(user_id, ticket_id, 1552650000)
+
+    store.exec_sql = exec_sql
+
+    for sql, args in statements:
+        if not sql.startswith(('select', 'update')):
+            continue
+        rows = exec_sql('explain query plan ' + sql, *args)
+        for row in rows:
+            assert not row[-1].startswith('SCAN'), (sql, row[-1])
+
+    statements.clear()
+    store.exec_sql = record
+
+    store.get_balance_of(user_id, 1552650000)
+    store.get_total_supply(1552650000)
+    store.sweep_expired(1552650000)
+
+    store.exec_sql = exec_sql
+
+    statements = [(sql, args) for sql, args in statements
+            if sql.startswith('select')]
+    indices = ['ticket_balance_table_key', 'ticket_supply_table_key',
+            'ticket_balance_table_end', 'ticket_attribute_table_interval']
+    assert len(statements) == len(indices)
+    for (sql, args), index in zip(statements, indices):
+        rows = exec_sql('explain query plan ' + sql, *args)
+        assert ' INDEX {0} ('.format(index) in rows[0][-1], (sql, rows)
+
+    store.close()
+
+
+def test_migrate_backfill():
+
+    store = ticket_lib.Store(domain_id, service_id, None)
+
+    user_id = bbclib.get_new_id("backfill user")
+    tx_id = bbclib.get_new_id("backfill tx")
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+    })
+    dat = ticket_lib.Ticket(spec=spec, time_of_origin=1552600000).serialize()
+    ticket_id = hashlib.sha256(dat).digest()
+
+    # a ticket and utxo as written before the derived tables existed.
+    store.exec_sql('insert into ticket_id_table values (?, ?, ?, ?)',
+            ticket_id, dat, None, None)
+    store.write_utxo(user_id, tx_id, 0, ticket_id, True)
+    # version 3 is the last schema before the backfill.
+    store.exec_sql('update ticket_schema_table set version=?', 3)
+    store.close()
+
+    store = ticket_lib.Store(domain_id, service_id, None)
+
+    assert store.is_valid(ticket_id, 1552650000)
+    assert store.get_balance_of(user_id) == {'yen': 830}
+
+    store.close()
+
+
+def test_idempotent_writes():
+
+    store = ticket_lib.Store(domain_id, service_id, None)
+
+    user_id = bbclib.get_new_id("idempotent user")
+    tx_id = bbclib.get_new_id("idempotent tx")
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+    })
+    dat = ticket_lib.Ticket(spec=spec, time_of_origin=1552600000).serialize()
+    ticket_id = hashlib.sha256(dat).digest()
+
+    store.put_ticket(ticket_id, dat)
+    store.put_ticket(ticket_id, dat)
+
+    rows = store.exec_sql(
+            'select count(*) from ticket_id_table where ticket_id=?',
+            ticket_id)
+    assert rows[0][0] == 1
+
+    assert store.write_utxo(user_id, tx_id, 0, ticket_id, True)
+    assert not store.write_utxo(user_id, tx_id, 0, ticket_id, True)
+    assert store.write_utxos(tx_id, [(user_id, 0, ticket_id, None),
+            (user_id, 1, ticket_id, None)]) == [(user_id, 1, ticket_id, None)]
+
+    assert len(store.read_utxo_list(user_id)) == 2
+
+    store.close()
+
+
+def test_concurrency():
+
+    store = ticket_lib.Store(domain_id, service_id, None)
+    store_b = ticket_lib.Store(domain_id, service_id, None)
+
+    assert store.lock is store_b.lock
+    assert ticket_lib.Store.get_lock(b'another database') is not store.lock
+
+    user_id = bbclib.get_new_id("concurrency user")
+    tx_id = bbclib.get_new_id("concurrency tx")
+    ticket_id = bbclib.get_new_id("concurrency ticket")
+
+    store.begin()
+    store.write_utxo(user_id, tx_id, 0, ticket_id, True)
+
+    results = []
+
+    def read():
+        results.append(len(store_b.read_utxo_list(user_id)))
+
+    readers = [threading.Thread(target=read) for i in range(4)]
+    for thread in readers:
+        thread.start()
+    for thread in readers:
+        thread.join(10)
+
+    # readers do not wait for the open write transaction.
+    assert results == [0] * 4
+
+    store.commit()
+
+    def write(k):
+        for i in range(50):
+            store.write_utxo(user_id, tx_id, 1 + k * 50 + i, ticket_id, True)
+
+    writers = [threading.Thread(target=write, args=(k,)) for k in range(8)]
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+
+    assert len(store.read_utxo_list(user_id)) == 1 + 8 * 50
+
+    store_b.close()
+    store.close()
+
+
+def test_independent_stores():
+
+    store_a = ticket_lib.Store(domain_id, service_id, None)
+    store_b = ticket_lib.Store(bbclib.get_new_id("independent domain"),
+            service_id, None)
+
+    assert store_a.lock is not store_b.lock
+
+    user_id = bbclib.get_new_id("independent user")
+    tx_id = bbclib.get_new_id("independent tx")
+    ticket_id = bbclib.get_new_id("independent ticket")
+
+    store_a.begin()
+    store_a.write_utxo(user_id, tx_id, 0, ticket_id, True)
+
+    written = threading.Event()
+
+    def write():
+        store_b.begin()
+        store_b.write_utxo(user_id, tx_id, 0, ticket_id, True)
+        store_b.commit()
+        written.set()
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+
+    # a transaction on one database does not hold up another database.
+    assert written.wait(10)
+
+    store_a.commit()
+    thread.join()
+
+    assert len(store_b.read_utxo_list(user_id)) == 1
+
+    store_b.close()
+    store_a.close()
+
+
+def test_inserted_transaction():
+
+    store = ticket_lib.Store(domain_id, service_id, None)
+
+    user_id = bbclib.get_new_id("inserted user")
+
+    spec = ticket_lib.TicketSpec({
+        'description': "Yokohama Municipal Subway:1 Day Pass",
+        'value': 830,
+        'unit': "yen",
+    })
+
+    tx = bbclib.make_transaction(event_num=2)
+    for event in tx.events:
+        event.asset_group_id = service_id
+        event.asset.add(user_id=user_id, asset_body=ticket_lib.Ticket(
+                spec=spec, time_of_origin=1552600000).serialize())
+    tx.digest()
+
+    store.push_tx(tx.transaction_id, tx)
+
+    update_balance = store.update_balance
+
+    def fail(*args):
+        raise RuntimeError('injected failure')
+
+    store.update_balance = fail
+
+    spec = None
+    try:
+        store.inserted(tx.transaction_id)
+    except RuntimeError:
+        spec = 1
+    assert spec == 1
+
+    assert len(store.read_utxo_list(user_id)) == 0
+    rows = store.exec_sql(
+            'select is_committed from ticket_tx_id_table where tx_id=?',
+            tx.transaction_id)
+    assert rows[0][0] == 0
+
+    store.update_balance = update_balance
+    store.inserted(tx.transaction_id)
+
+    assert len(store.read_utxo_list(user_id)) == 2
+    assert store.get_balance_of(user_id) == {'yen': 830 * 2}
+    rows = store.exec_sql(
+            'select is_committed from ticket_tx_id_table where tx_id=?',
+            tx.transaction_id)
+    assert rows[0][0] == 1
+    assert store.tx_cache.get(tx.transaction_id) is not None
+
+    store.tx_cache.clear()
+
+    assert store.get_local_tx(tx.transaction_id) is not None
+
+    store.inserted(tx.transaction_id)
+
+    assert store.get_balance_of(user_id) == {'yen': 830 * 2}
+
+    store.close()
+
+
 def test_transferable():
 
     service = ticket_lib.BBcTicketService(domain_id, service_id, service_id,